@@ -1,24 +1,76 @@
 import os
+import functools
+from dataclasses import dataclass
+from typing import Optional
 from dotenv import load_dotenv
 
-# Load environment variables from .env file
-load_dotenv()
+# Per-user, so cached conversation text never lands in a shared directory such as /tmp
+_DEFAULT_LLM_DISK_CACHE_DIR = os.path.join(
+    os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "godmode", "llm_cache"
+)
 
-# Database configuration
-DATABASE_URL = "./nohup.db"
+@dataclass(frozen=True, slots=True)
+class Settings:
+    """Application settings. Read once via get_settings(); tests can override with get_settings.cache_clear()."""
 
-# API Keys
-TAVILY_API_KEY = os.getenv("TAVILY_API_KEY")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+    # Database configuration
+    database_url: str = "./nohup.db"
+    db_pool_readers: int = 4  # Read connections shared by all sessions (writes use one dedicated connection)
 
-# LLM Configuration
-DEFAULT_MODEL = "gpt-4.1-mini"
-PLANNER_MODEL = "o3-mini"
+    # API Keys
+    tavily_api_key: Optional[str] = None
+    openai_api_key: Optional[str] = None
 
-# Browser Configuration
-CHROME_PATH = '/Applications/Google Chrome.app/Contents/MacOS/Google Chrome'  # macOS path
+    # LLM Configuration
+    default_model: str = "gpt-4.1-mini"
+    planner_model: str = "o3-mini"
+    llm_max_concurrency: int = 32  # Max simultaneous LLM streams per process
+    llm_batch_window_ms: int = 0  # >0 groups concurrent requests (for self-hosted vLLM/sglang servers)
+    llm_batch_max_size: int = 16
 
-# WebSocket Configuration
-WS_HOST = "localhost"
-WS_PORT = 8000
-WS_ENDPOINT = "/ws" 
\ No newline at end of file
+    # LLM Response Cache Configuration (set LLM_CACHE=1 to replay identical requests locally)
+    llm_cache_enabled: bool = False
+    llm_cache_max_size: int = 512
+    llm_disk_cache_dir: str = _DEFAULT_LLM_DISK_CACHE_DIR  # Persistent tier (needs diskcache), created owner-only
+    llm_disk_cache_ttl: int = 3600  # Seconds
+
+    # Agent Memory Configuration
+    max_memory_tokens: int = 8000  # Oldest messages are evicted once memory exceeds this estimate
+    recent_turns_kept: int = 2  # The latest user turns (and everything after them) are never evicted
+    recent_messages_kept_verbatim: int = 20  # Older tool outputs are truncated in the request (memory keeps them whole)
+    old_tool_output_max_chars: int = 2000  # Head + tail kept from an old tool output
+    warm_agent_ttl: int = 600  # Seconds a closed chat's agent is kept in memory so a reconnect skips the history reload
+
+    # Streaming Configuration
+    stream_flush_ms: int = 30  # Streamed text is coalesced into flushes of this interval; 0 sends every delta
+
+    # Browser Configuration
+    chrome_path: str = '/Applications/Google Chrome.app/Contents/MacOS/Google Chrome'  # macOS path
+
+    # WebSocket Configuration
+    ws_host: str = "localhost"
+    ws_port: int = 8000
+    ws_endpoint: str = "/ws"
+    client_reply_timeout: int = 300  # Seconds a step waits for results of approved, running client tools before giving up on them
+
+
+@functools.lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Loads the .env file and the environment once and returns the shared Settings."""
+    load_dotenv()
+    return Settings(
+        tavily_api_key=os.getenv("TAVILY_API_KEY"),
+        openai_api_key=os.getenv("OPENAI_API_KEY"),
+        llm_max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "32")),
+        llm_batch_window_ms=int(os.getenv("LLM_BATCH_WINDOW_MS", "0")),
+        llm_cache_enabled=os.getenv("LLM_CACHE") == "1",
+        llm_disk_cache_dir=os.getenv("LLM_DISK_CACHE_DIR", _DEFAULT_LLM_DISK_CACHE_DIR),
+    )
+
+
+def __getattr__(name: str):
+    """Keeps the old module constants (e.g. `from app.config import DATABASE_URL`) working."""
+    field_name = name.lower()
+    if name.isupper() and field_name in Settings.__dataclass_fields__:
+        return getattr(get_settings(), field_name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
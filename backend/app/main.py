@@ -1,22 +1,33 @@
 import os
 import json
+import logging
 import traceback
 import asyncio # Added for future handling
 import base64 # Added
 import aiofiles # Added
-import uuid # Added
+import re
+import time
 import datetime # Added for DB timestamps
-import aiosqlite # ADDED
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
 # Import from new locations
 from core.agent.agent import ChatAgent
-from db.operations import init_db, save_message_to_db, update_chat_metadata_in_db, update_chat_title_in_db, DATABASE_URL
+from core.tools.base import ToolContext
+from db.operations import (
+    init_db, save_messages_to_db, update_chat_metadata_in_db, attachment_from_data_url, load_attachment_urls,
+    mark_chat_active, flush_last_active, flush_last_active_periodically,
+)
 from services.transcription import get_transcription
+from services.llm import close_llm_http_client
+from db.pool import db_pool
+from utils.logging_utils import start_logging, stop_logging
+from utils import json_utils
 from app.websocket.handler import run_agent_step_and_send
-from typing import List, Dict, Any, Callable, Tuple, Optional
+from app.websocket.outbox import Message, Outbox
+from app.config import get_settings
+from typing import List, Dict, Any, Awaitable, Callable, Set, Tuple, Optional
 from contextlib import asynccontextmanager
 
 # --- Import Server Tool Registry --- 
@@ -29,15 +40,52 @@ from contextlib import asynccontextmanager
 # Load environment variables from .env file
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # --- Global state for active connections ---
 # Key: connection_key (e.g., str(websocket.client)), Value: Dict containing chat_id, agent, total_cost
 ACTIVE_CONNECTIONS: Dict[str, Dict[str, Any]] = {}
 # --- End Global State ---
+
+# --- Warm agents of recently closed connections ---
+# Key: chat_id, Value: (agent, total_cost, needs_title, time.monotonic() when the connection closed)
+WARM_AGENTS: Dict[str, Tuple[ChatAgent, float, bool, float]] = {}
+_WARM_AGENT_TTL = get_settings().warm_agent_ttl
+
+
+def _take_warm_agent(chat_id: str) -> Optional[Tuple[ChatAgent, float, bool]]:
+    """Removes and returns the chat's warm (agent, total_cost, needs_title), if it hasn't expired."""
+    warm = WARM_AGENTS.pop(chat_id, None)
+    if warm is None or time.monotonic() - warm[3] > _WARM_AGENT_TTL:
+        return None
+    return warm[0], warm[1], warm[2]
+
+
+async def _evict_warm_agents(interval: float = 60.0) -> None:
+    """Drops expired warm agents periodically so idle chats don't hold their history in memory."""
+    while True:
+        await asyncio.sleep(interval)
+        cutoff = time.monotonic() - _WARM_AGENT_TTL
+        for chat_id in [chat_id for chat_id, warm in WARM_AGENTS.items() if warm[3] < cutoff]:
+            del WARM_AGENTS[chat_id]
+# --- End Warm Agents ---
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup code (runs before the application starts)
+    start_logging()
     await init_db()
+    await db_pool.open()
+    eviction_task = asyncio.create_task(_evict_warm_agents())
+    last_active_task = asyncio.create_task(flush_last_active_periodically())
     yield
+    # Shutdown code
+    eviction_task.cancel()
+    last_active_task.cancel()
+    await flush_last_active() # Write whatever the cancelled task hadn't flushed yet
+    await db_pool.close()
+    await close_llm_http_client()
+    stop_logging()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -56,10 +104,411 @@ app.add_middleware(
 #     await init_db()
 
 
+# --- Outgoing Messages ---
+def _send(connection_state: Dict[str, Any], message: Message) -> None:
+    """Queues a reply on the connection's outbox, so it goes out in order behind the frames a step
+    has queued and the caller never waits on the socket.
+    """
+    connection_state["outbox"].put_nowait(message)
+
+# Fixed replies, serialized once at import
+_ERR_MISSING_TEXT = json_utils.dumps_bytes({"type": "error", "content": "Missing text in user_message"})
+_ERR_INVALID_RESULTS = json_utils.dumps_bytes({"type": "error", "content": "Missing or invalid results in tool_result message"})
+_ERR_INVALID_USER_RESPONSE = json_utils.dumps_bytes({"type": "error", "content": "Missing request_id or answer in user_response"})
+_ERR_INVALID_MODEL = json_utils.dumps_bytes({"type": "error", "content": "Invalid or missing model_name in set_llm_model message"})
+_ERR_INVALID_API_KEYS = json_utils.dumps_bytes({"type": "error", "content": "Invalid or missing 'keys' dictionary in set_api_keys message"})
+_ERR_MISSING_AUDIO = json_utils.dumps_bytes({"type": "error", "content": "Missing audio_data in audio_input message"})
+_INFO_STOP_RECEIVED = json_utils.dumps_bytes({"type": "info", "content": "Stop request received"})
+_ERR_NO_CHAT_ID = json_utils.dumps_bytes({"type": "error", "content": "chat_id query parameter is required."})
+_ERR_INVALID_CHAT_ID = json_utils.dumps_bytes({"type": "error", "content": "Invalid chat_id format."})
+_ERR_SESSION_INIT = json_utils.dumps_bytes({"type": "error", "content": "Failed to initialize chat session."})
+_ERR_INVALID_JSON = json_utils.dumps_bytes({"type": "error", "content": "Invalid JSON received"})
+_ERR_UNEXPECTED = json_utils.dumps_bytes({"type": "error", "content": "Unexpected WebSocket error"})
+# --- End Outgoing Messages ---
+
+# --- User Message Formatting ---
+_CONTEXT_PREFIX = "Based on this context:\n```\n"
+_CONTEXT_SUFFIX = "\n```\n\n"
+# --- End User Message Formatting ---
+
+# --- Chat ID Validation ---
+_is_valid_chat_id = re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}').fullmatch
+# --- End Chat ID Validation ---
+
+# --- History Loading ---
+_HISTORY_FETCH_SIZE = 256 # Rows fetched per round trip to the database thread
+_JSON_ROLES = frozenset({"user", "tool"}) # Roles whose content may have been stored as JSON
+_JSON_START_CHARS = frozenset("[{") # Anything else is plain text, so don't try to parse it
+
+
+def _resolve_image_refs(content: List[Any], attachment_urls: Dict[str, str]) -> List[Any]:
+    """Turns stored {"type": "image_ref"} parts back into the image_url parts the LLM expects."""
+    return [
+        {"type": "image_url", "image_url": {"url": attachment_urls[part["id"]]}}
+        if isinstance(part, dict) and part.get("type") == "image_ref" and part.get("id") in attachment_urls
+        else part
+        for part in content
+    ]
+# --- End History Loading ---
+
 # --- Shared state for pending agent questions --- 
 PENDING_AGENT_QUESTIONS: Dict[str, Dict[str, asyncio.Future]] = {}
 # --- End Shared State ---
 
+# --- WebSocket Message Handlers ---
+async def _handle_user_message(websocket: WebSocket, connection_state: Dict[str, Any], message_data: Dict[str, Any]) -> None:
+    """Adds the user's message (or the answer to a pending ask_user) to memory and runs an agent step."""
+    chat_id = connection_state["chat_id"]
+    agent: ChatAgent = connection_state["agent"]
+    api_keys = connection_state["api_keys"]
+    # A new turn: a stop aimed at the previous one no longer applies
+    connection_state["stop_requested"] = False
+    connection_state["stop_event"].clear()
+    # ... (logic for getting text, screenshot, context remains same)
+    text = message_data.get("text")
+    screenshot_data_url = message_data.get("screenshot_data_url")
+    context_text = message_data.get("context_text")
+    
+    if not text:
+        _send(connection_state, _ERR_MISSING_TEXT)
+        return
+    
+    print(f"[WebSocket ({chat_id})] Processing user_message: {text[:50]}...")
+    
+    # Check if this is the first message and set chat title (saved together with the message below)
+    title: Optional[str] = None
+    if connection_state["needs_title"]:
+        # Use first 50 chars of message as title, or up to first newline
+        first_line, newline, _ = text.partition('\n')
+        title = first_line[:50]
+        if newline or len(first_line) > 50:
+            title += "..."
+        connection_state["needs_title"] = False
+    
+    # ... (logic for adding message to agent memory remains same, using retrieved agent) ...
+    if agent.pending_ask_user_tool_call_id:
+        tool_call_id = agent.pending_ask_user_tool_call_id
+        agent.add_message_to_memory(role="tool", tool_call_id=tool_call_id, content=text)
+        await save_messages_to_db(chat_id, [("tool", text, tool_call_id)], title=title)
+        agent.pending_ask_user_tool_call_id = None
+    else:
+        # ... prepare user content ...
+        final_text_content = text
+        if context_text and not context_text.isspace(): # isspace() checks without copying the context
+            final_text_content = "".join((_CONTEXT_PREFIX, context_text, _CONTEXT_SUFFIX, text))
+        user_content: List[Dict[str, Any]] = [{"type": "text", "text": final_text_content}]
+        stored_content = user_content # What goes into the messages table
+        attachments = []
+        if screenshot_data_url:
+            user_content.append({
+                "type": "image_url",
+                "image_url": {"url": screenshot_data_url}
+            })
+            # Store the image bytes separately and keep only a reference in the message JSON
+            attachment = attachment_from_data_url(screenshot_data_url)
+            if attachment:
+                attachments.append(attachment)
+                stored_content = [user_content[0], {"type": "image_ref", "id": attachment[0]}]
+        agent.add_message_to_memory(role="user", content=user_content)
+        await save_messages_to_db(chat_id, [("user", stored_content, None)], title=title, attachments=attachments)
+    if title is not None:
+        print(f"[WebSocket ({chat_id})] Set initial chat title: {title}")
+    
+    # --- Run the agent step (using retrieved agent) --- 
+    agent_finished_turn, step_cost = await run_agent_step_and_send(
+        agent, websocket, PENDING_AGENT_QUESTIONS, 
+        api_keys=api_keys, # Pass keys
+        connection_state=connection_state # Pass connection state
+    )
+    if step_cost is not None:
+        connection_state["total_cost"] += step_cost
+        new_total_cost = connection_state["total_cost"]
+        # --- Update DB --- 
+        await update_chat_metadata_in_db(chat_id, total_cost=new_total_cost)
+        # --- End DB Update --- 
+        print(f"[WebSocket ({chat_id})] LLM call cost: ${step_cost:.6f}, Session total: ${new_total_cost:.6f}")
+        _send(connection_state, {
+            "type": "cost_update",
+            "total_cost": new_total_cost
+        })
+    else:
+        print(f"[WebSocket ({chat_id}) WARNING] Agent step finished but no cost was returned.")
+
+
+async def _handle_tool_result(websocket: WebSocket, connection_state: Dict[str, Any], message_data: Dict[str, Any]) -> None:
+    """Records client tool results and runs the next agent step once every requested call has a result."""
+    chat_id = connection_state["chat_id"]
+    agent: ChatAgent = connection_state["agent"]
+    api_keys = connection_state["api_keys"]
+    # ... (logic for getting results remains same) ...
+    results = message_data.get("results")
+    if not results or not isinstance(results, list): 
+        _send(connection_state, _ERR_INVALID_RESULTS)
+        return
+        
+    print(f"[WebSocket ({chat_id})] Processing tool_result for {len(results)} tool(s)...")
+    
+    # The calls from the latest tool_call_request, recorded by run_agent_step_and_send
+    requested_tool_calls: List[Dict[str, Any]] = connection_state["requested_tool_calls"]
+    expected_tool_call_ids: Set[str] = connection_state["expected_tool_call_ids"]
+    
+    # Collect the received results (tools may have finished in any order)
+    result_contents: Dict[str, str] = {}
+    for result in results:
+        tool_call_id = result.get("tool_call_id")
+        if not tool_call_id:
+            print(f"[WebSocket ({chat_id}) WARNING] Received tool_result missing tool_call_id")
+        elif tool_call_id not in expected_tool_call_ids or agent.has_tool_response(tool_call_id):
+            # Late (e.g. after the step timed out on it) or unknown: a second tool message would break the history
+            print(f"[WebSocket ({chat_id}) WARNING] Ignoring tool_result for unexpected or already answered call {tool_call_id}")
+        else:
+            result_contents[tool_call_id] = str(result.get("content", ""))
+            expected_tool_call_ids.discard(tool_call_id)
+            connection_state["started_tool_call_ids"].discard(tool_call_id)
+    if not result_contents:
+        return # Nothing new, so there is no step to run
+
+    # Add them to memory in the order the calls were requested, and save them with a single commit
+    added_results = agent.add_tool_results_to_memory(result_contents, requested_tool_calls)
+    await save_messages_to_db(chat_id, [("tool", content, tool_call_id) for tool_call_id, content in added_results])
+    
+    # Check if we have all expected tool results
+    if expected_tool_call_ids:
+        print(f"[WebSocket ({chat_id})] Still waiting for tool results: {expected_tool_call_ids}")
+        return  # Don't proceed with agent step until we have all results
+     
+    if logger.isEnabledFor(logging.DEBUG): # Serializes the whole conversation, skip unless someone reads it
+        logger.debug("[WebSocket (%s) DEBUG] Agent memory AFTER adding tool results:\n%s", chat_id, json_utils.dumps(agent.memory, pretty=True))
+    
+    # --- Run agent step again (using retrieved agent) --- 
+    print(f"[WebSocket ({chat_id})] All tool results received. Triggering agent step...")
+    agent_finished_turn, step_cost = await run_agent_step_and_send(
+        agent, websocket, PENDING_AGENT_QUESTIONS, 
+        api_keys=api_keys, # Pass keys
+        connection_state=connection_state # Pass connection state
+    )
+    if step_cost is not None:
+        connection_state["total_cost"] += step_cost
+        new_total_cost = connection_state["total_cost"]
+        # --- Update DB --- 
+        await update_chat_metadata_in_db(chat_id, total_cost=new_total_cost)
+        # --- End DB Update --- 
+        print(f"[WebSocket ({chat_id})] LLM call cost: ${step_cost:.6f}, Session total: ${new_total_cost:.6f}")
+        _send(connection_state, {
+            "type": "cost_update",
+            "total_cost": new_total_cost
+        })
+    else:
+        print(f"[WebSocket ({chat_id}) WARNING] Agent step finished but no cost was returned.")
+
+
+async def _handle_user_response(websocket: WebSocket, connection_state: Dict[str, Any], message_data: Dict[str, Any]) -> None:
+    """Resolves the pending agent question the client answered."""
+    chat_id = connection_state["chat_id"]
+    connection_key = connection_state["connection_key"]
+    # ... (logic for getting request_id, answer remains same) ...
+    request_id = message_data.get("request_id")
+    answer = message_data.get("answer")
+    if not request_id or answer is None: 
+        _send(connection_state, _ERR_INVALID_USER_RESPONSE)
+        return
+
+    print(f"[WebSocket ({chat_id})] Processing user_response for request_id: {request_id}")
+    # --- Use connection_key for PENDING_AGENT_QUESTIONS --- 
+    future = PENDING_AGENT_QUESTIONS.get(connection_key, {}).get(request_id)
+
+    if future and not future.done():
+        print(f"[WebSocket ({chat_id})] Found pending future for {request_id}. Setting result.")
+        future.set_result(answer) 
+    elif future and future.done():
+        print(f"[WebSocket ({chat_id}) WARNING] Received user_response for already completed request_id: {request_id}")
+    else:
+        print(f"[WebSocket ({chat_id}) WARNING] Received user_response for unknown or expired request_id: {request_id} for connection {connection_key}")
+        _send(connection_state, {"type": "warning", "content": f"Received response for unknown or expired request ID {request_id}."})
+    # --- End user_response handling --- 
+
+
+async def _handle_set_llm_model(websocket: WebSocket, connection_state: Dict[str, Any], message_data: Dict[str, Any]) -> None:
+    """Switches the session's model and persists the choice."""
+    chat_id = connection_state["chat_id"]
+    agent: ChatAgent = connection_state["agent"]
+    # ... (logic for getting model_name remains same) ...
+    model_name = message_data.get("model_name")
+    if model_name and isinstance(model_name, str):
+        print(f"[WebSocket ({chat_id})] Received request to set model to: {model_name}")
+        agent.set_model(model_name) # Use retrieved agent
+        # --- Update DB --- 
+        current_total_cost = connection_state["total_cost"] # Get current cost from connection state
+        await update_chat_metadata_in_db(chat_id, total_cost=current_total_cost, current_model=model_name)
+        # --- End DB Update --- 
+    else:
+        print(f"[WebSocket ({chat_id}) WARNING] Received invalid set_llm_model message: {message_data}")
+        _send(connection_state, _ERR_INVALID_MODEL)
+
+
+async def _handle_set_api_keys(websocket: WebSocket, connection_state: Dict[str, Any], message_data: Dict[str, Any]) -> None:
+    """Replaces the session's API keys."""
+    chat_id = connection_state["chat_id"]
+    api_keys = connection_state["api_keys"]
+    keys_data = message_data.get("keys")
+    if isinstance(keys_data, dict):
+        print(f"[WebSocket ({chat_id})] Received request to set API keys.")
+        # Validate keys (basic validation)
+        validated_keys = {k: v for k, v in keys_data.items() if isinstance(k, str) and isinstance(v, str)}
+        api_keys.clear() # Update the session's dict in place
+        api_keys.update(validated_keys)
+        print(f"[WebSocket ({chat_id})] Updated API keys for session: {list(validated_keys.keys())}")
+        # Optional: Send confirmation back to client
+        _send(connection_state, {"type": "info", "content": f"API keys received for providers: {list(validated_keys.keys())}"})
+    else:
+         print(f"[WebSocket ({chat_id}) WARNING] Received invalid set_api_keys message: {message_data}")
+         _send(connection_state, _ERR_INVALID_API_KEYS)
+
+
+async def _handle_audio_input(websocket: WebSocket, connection_state: Dict[str, Any], message_data: Dict[str, Any]) -> None:
+    """Transcribes recorded audio and sends the text back."""
+    chat_id = connection_state["chat_id"]
+    # ... (logic for getting audio data, format remains same) ...
+    audio_data_base64 = message_data.get("audio_data")
+    audio_format = message_data.get("format", "webm")
+    if not audio_data_base64:
+        _send(connection_state, _ERR_MISSING_AUDIO)
+        return
+    
+    print(f"[WebSocket ({chat_id})] Processing audio_input (format: {audio_format})...")
+    # ... (transcription call and error handling remain same) ...
+    try:
+        transcription_text = await get_transcription(audio_data_base64, audio_format)
+        print(f"[WebSocket ({chat_id})] Transcription successful: '{transcription_text[:100]}...'")
+        _send(connection_state, {
+            "type": "transcription_result",
+            "text": transcription_text
+        })
+        print(f"[WebSocket ({chat_id})] Sent transcription_result to client.")
+    except HTTPException as http_exc:
+        print(f"[WebSocket ({chat_id}) Error] Transcription HTTP Exception: {http_exc.detail}")
+        _send(connection_state, {"type": "error", "content": f"Transcription Error: {http_exc.detail}"})
+    except Exception as trans_exc:
+        print(f"[WebSocket ({chat_id}) Error] Unexpected error during transcription processing: {trans_exc}")
+        traceback.print_exc()
+        _send(connection_state, {"type": "error", "content": f"Unexpected transcription error: {trans_exc}"})
+
+
+async def _handle_stop(websocket: WebSocket, connection_state: Dict[str, Any], message_data: Dict[str, Any]) -> None:
+    """Acknowledges a stop request from the client."""
+    chat_id = connection_state["chat_id"]
+    print(f"[WebSocket ({chat_id})] Received stop request")
+    connection_state["stop_requested"] = True
+    connection_state["stop_event"].set() # Wakes a step that is waiting on client tool results
+    
+    # Send acknowledgment back to client
+    _send(connection_state, _INFO_STOP_RECEIVED)
+    # Note: The actual stopping and tool cancellation will happen in the websocket handler
+    
+    # The flag stays set so the running step sees it; the next turn starts with it cleared
+
+
+_MESSAGE_HANDLERS: Dict[str, Callable[[WebSocket, Dict[str, Any], Dict[str, Any]], Awaitable[None]]] = {
+    "user_message": _handle_user_message,
+    "tool_result": _handle_tool_result,
+    "user_response": _handle_user_response,
+    "set_llm_model": _handle_set_llm_model,
+    "set_api_keys": _handle_set_api_keys,
+    "audio_input": _handle_audio_input,
+    "stop": _handle_stop,
+}
+# --- End WebSocket Message Handlers ---
+
+
+# Handled by the reader as soon as they arrive, so they aren't stuck behind a running agent step
+_CONTROL_MESSAGE_TYPES = frozenset({"stop", "user_response"})
+
+
+async def _dispatch_message(websocket: WebSocket, connection_state: Dict[str, Any], message_data: Dict[str, Any]) -> None:
+    """Runs the handler for one client message, reporting failures back to the client."""
+    chat_id = connection_state["chat_id"]
+    try:
+        message_type = message_data.get("type")
+
+        handler = _MESSAGE_HANDLERS.get(message_type)
+        if handler is None:
+            print(f"[WebSocket ({chat_id}) WARNING] Invalid message type received: {message_type}")
+            _send(connection_state, {"type": "error", "content": f"Invalid message type received: {message_type}"})
+        else:
+            await handler(websocket, connection_state, message_data)
+    except Exception as e:
+        print(f"Error processing message via WebSocket ({chat_id}) (see traceback below):")
+        traceback.print_exc() 
+        error_message = str(e)
+        _send(connection_state, {"type": "error", "content": f"Error processing request: {error_message}"})
+
+
+async def _read_client_messages(websocket: WebSocket, connection_state: Dict[str, Any]) -> None:
+    """Reads frames for the connection's lifetime: control messages are handled right away and
+    everything else is queued on the inbox, so a step waiting on tool results can drain it in one go.
+    """
+    chat_id = connection_state["chat_id"]
+    inbox: "asyncio.Queue[Optional[Dict[str, Any]]]" = connection_state["inbox"]
+    tool_results: "asyncio.Queue[Optional[Dict[str, Any]]]" = connection_state["tool_results"]
+    try:
+        while True:
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                break
+            # Text or binary frames: orjson parses UTF-8 bytes directly, so binary skips a decode
+            data = frame.get("text")
+            if data is None:
+                data = frame.get("bytes") or b""
+            logger.debug("WebSocket (%s) received: %.200s...", chat_id, data) # Per-frame, so only formatted at DEBUG
+            try:
+                message_data = json_utils.loads(data)
+            except json.JSONDecodeError:
+                print(f"WebSocket ({chat_id}) received invalid JSON")
+                _send(connection_state, _ERR_INVALID_JSON)
+                continue
+            message_type = message_data.get("type") if isinstance(message_data, dict) else None
+            if message_type in _CONTROL_MESSAGE_TYPES:
+                await _dispatch_message(websocket, connection_state, message_data)
+            elif message_type == "tool_result" and connection_state["awaiting_tool_results"]:
+                await tool_results.put(message_data) # Straight to the waiting step, ahead of other queued messages
+            elif message_type == "tool_call_started":
+                # The user approved these calls; the waiting step starts its reply timeout from here
+                connection_state["started_tool_call_ids"].update(message_data.get("tool_call_ids") or ())
+                if connection_state["awaiting_tool_results"]:
+                    await tool_results.put(message_data)
+            else:
+                inbox.put_nowait(message_data)
+    finally:
+        inbox.put_nowait(None) # Wakes whoever is waiting on the inbox
+        while tool_results.full(): # Nobody can reply to these any more; make room for the marker
+            tool_results.get_nowait()
+        tool_results.put_nowait(None)
+
+
+async def _release_connection(connection_key: str) -> None:
+    """Drops everything held for a closed connection; safe to call whatever state the connection got to."""
+    # --- Remove connection state --- 
+    removed_state = ACTIVE_CONNECTIONS.pop(connection_key, None)
+    if removed_state is not None:
+        removed_chat_id = removed_state["chat_id"]
+        await removed_state["outbox"].close()
+        # Keep the agent warm for a quick reconnect, unless it is still waiting on client tool results
+        if not removed_state["expected_tool_call_ids"]:
+            WARM_AGENTS[removed_chat_id] = (removed_state["agent"], removed_state["total_cost"], removed_state["needs_title"], time.monotonic())
+        print(f"Removed connection state for {connection_key} (chat_id: {removed_chat_id}). Active connections: {len(ACTIVE_CONNECTIONS)}")
+    await flush_last_active()
+    # --- End remove connection state ---
+
+    # --- Cleanup agent questions for this connection (using connection_key) ---
+    pending_questions = PENDING_AGENT_QUESTIONS.pop(connection_key, None)
+    if pending_questions:
+        print(f"[WebSocket Cleanup] Cleaning up pending questions for connection {connection_key} on disconnect.")
+        for request_id, future in pending_questions.items():
+            if not future.done():
+                future.cancel("WebSocket connection closed.")
+    # --- End Cleanup ---
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
@@ -69,14 +518,12 @@ async def websocket_endpoint(websocket: WebSocket):
     chat_id = websocket.query_params.get("chat_id")
     if not chat_id:
         print("WebSocket closing: chat_id missing from query parameters.")
-        await websocket.send_text(json.dumps({"type": "error", "content": "chat_id query parameter is required."}))
+        await websocket.send_bytes(_ERR_NO_CHAT_ID)
         await websocket.close(code=1008)
         return
-    try: # Validate chat_id format (e.g., UUID) if desired
-        uuid.UUID(chat_id)
-    except ValueError:
+    if not _is_valid_chat_id(chat_id): # Canonical hyphenated UUID, as generated by the client
         print(f"WebSocket closing: Invalid chat_id format: {chat_id}")
-        await websocket.send_text(json.dumps({"type": "error", "content": "Invalid chat_id format."}))
+        await websocket.send_bytes(_ERR_INVALID_CHAT_ID)
         await websocket.close(code=1008)
         return
     print(f"WebSocket attempting connection for chat_id: {chat_id}")
@@ -88,346 +535,124 @@ async def websocket_endpoint(websocket: WebSocket):
 
     # --- Load or Create Chat State from DB --- 
     try:
-        async with aiosqlite.connect(DATABASE_URL) as db:
-            db.row_factory = aiosqlite.Row # Access columns by name
-            async with db.execute("SELECT * FROM chats WHERE chat_id = ?", (chat_id,)) as cursor:
-                chat_data = await cursor.fetchone()
+        warm = _take_warm_agent(chat_id) # Reconnects within the TTL reuse the agent instead of replaying history
+        chat_data = None
+        if warm is None:
+            async with db_pool.acquire() as db:
+                async with db.execute("SELECT * FROM chats WHERE chat_id = ?", (chat_id,)) as cursor:
+                    chat_data = await cursor.fetchone()
 
-            now = datetime.datetime.now(datetime.timezone.utc)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        
+        if warm is not None:
+            agent, session_total_cost, needs_title = warm
+            print(f"Reusing warm agent for chat: {chat_id} ({len(agent.memory)} messages in memory)")
             
-            if chat_data:
-                print(f"Loading existing chat: {chat_id}")
-                session_total_cost = chat_data['total_cost'] or 0.0
-                current_model = chat_data['current_model'] # Can be None
-                agent = ChatAgent(model_name=current_model) # Initialize agent, optionally with stored model (FIXED)
-                
-                # Load history
-                async with db.execute("SELECT role, content, tool_call_id FROM messages WHERE chat_id = ? ORDER BY timestamp ASC", (chat_id,)) as msg_cursor:
-                    async for row in msg_cursor:
-                        content = row['content']
-                        # Attempt to parse content if it looks like JSON (for user/tool roles)
-                        parsed_content: Any = content
-                        if row['role'] in ["user", "tool"] or (row['role'] == 'assistant' and 'tool_calls' in content):
-                             try:
-                                 parsed_content = json.loads(content)
-                             except json.JSONDecodeError:
-                                 print(f"[DB Load Warning] Could not parse message content for chat {chat_id}, role {row['role']}. Treating as string.")
-                                 # Keep content as string if parsing fails
-                        
-                        agent.add_message_to_memory(role=row['role'], content=parsed_content, tool_call_id=row['tool_call_id'])
-                print(f"Loaded {len(agent.memory)} messages from history for chat {chat_id}")
-                
-                # Update last active time
-                await db.execute("UPDATE chats SET last_active_at = ? WHERE chat_id = ?", (now, chat_id))
-                await db.commit()
+            # Update last active time (written by the next batched flush)
+            mark_chat_active(chat_id, now)
+        
+        elif chat_data:
+            print(f"Loading existing chat: {chat_id}")
+            session_total_cost = chat_data['total_cost'] or 0.0
+            needs_title = not chat_data['title'] # The first user message names the chat
+            current_model = chat_data['current_model'] # Can be None
+            agent = ChatAgent(model_name=current_model) # Initialize agent, optionally with stored model (FIXED)
             
-            else:
-                print(f"Creating new chat: {chat_id}")
-                agent = ChatAgent() # Create agent with default model
-                session_total_cost = 0.0
-                current_model = agent.model_name # Get default model (FIXED)
-                
+            # Load history (collected first, then handed to the agent in one bulk load)
+            history: List[Tuple[str, Any, Optional[str]]] = []
+            async with db_pool.acquire() as db:
+                attachment_urls = await load_attachment_urls(db, chat_id)
+                async with db.execute("SELECT role, content, tool_call_id FROM messages WHERE chat_id = ? ORDER BY message_id ASC", (chat_id,)) as msg_cursor: # Insert order; timestamps only have 1s resolution
+                    while rows := await msg_cursor.fetchmany(_HISTORY_FETCH_SIZE):
+                        for role, content, tool_call_id in rows:
+                            # Attempt to parse content if it looks like JSON (for user/tool roles)
+                            parsed_content: Any = content
+                            if content[:1] in _JSON_START_CHARS and (role in _JSON_ROLES or (role == 'assistant' and 'tool_calls' in content)):
+                                 try:
+                                     parsed_content = json_utils.loads(content)
+                                 except json.JSONDecodeError:
+                                     print(f"[DB Load Warning] Could not parse message content for chat {chat_id}, role {role}. Treating as string.")
+                                     # Keep content as string if parsing fails
+                            if role == "user" and attachment_urls and isinstance(parsed_content, list):
+                                parsed_content = _resolve_image_refs(parsed_content, attachment_urls)
+                            
+                            history.append((role, parsed_content, tool_call_id))
+            agent.load_memory(history)
+            print(f"Loaded {len(agent.memory)} messages from history for chat {chat_id}")
+            
+            # Update last active time (written by the next batched flush)
+            mark_chat_active(chat_id, now)
+        
+        else:
+            print(f"Creating new chat: {chat_id}")
+            agent = ChatAgent() # Create agent with default model
+            session_total_cost = 0.0
+            needs_title = True
+            current_model = agent.model_name # Get default model (FIXED)
+            
+            async with db_pool.writer() as db:
                 await db.execute(
                     "INSERT INTO chats (chat_id, created_at, last_active_at, current_model, total_cost) VALUES (?, ?, ?, ?, ?)",
                     (chat_id, now, now, current_model, session_total_cost)
                 )
                 await db.commit()
-                
+            
         # Store in active connections
         ACTIVE_CONNECTIONS[connection_key] = {
             "chat_id": chat_id,
+            "connection_key": connection_key,
             "agent": agent,
             "total_cost": session_total_cost,
+            "needs_title": needs_title,
             "api_keys": {}, # ADDED: Initialize empty dict for session API keys
             "stop_requested": False, # Add stop signal flag
-            "current_tool_calls": set() # Track active tool calls
+            "stop_event": asyncio.Event(), # Set together with stop_requested, for code that waits
+            "current_tool_calls": set(), # Track active tool calls
+            "requested_tool_calls": [], # Calls of the latest tool_call_request, in the order the agent made them
+            "expected_tool_call_ids": set(), # Client tool calls from that request still waiting for a result
+            "started_tool_call_ids": set(), # Client tool calls the user approved and the client is running
+            "outbox": Outbox(websocket), # Agent output is queued here and sent by one writer task
+            "inbox": asyncio.Queue(), # Parsed client messages, filled by the connection's reader task
+            "tool_results": asyncio.Queue(maxsize=64), # tool_result messages while a step waits for them (bounded for backpressure)
+            "awaiting_tool_results": False, # Whether a step is waiting on tool_results right now
+            "tool_context": ToolContext(websocket, connection_key, PENDING_AGENT_QUESTIONS) # Passed to server tools
         }
         print(f"WebSocket connection {connection_key} established for chat_id: {chat_id}")
         
     except Exception as db_error:
         print(f"[DB Error] Failed to load/create chat state for {chat_id}: {db_error}")
         traceback.print_exc()
-        await websocket.send_text(json.dumps({"type": "error", "content": "Failed to initialize chat session."}))
+        await websocket.send_bytes(_ERR_SESSION_INIT)
         await websocket.close(code=1011)
         return
     # --- End Load or Create Chat State ---
 
+    # --- Bind connection state (fixed for the connection's lifetime) --- 
+    connection_state = ACTIVE_CONNECTIONS[connection_key]
+    # --- End bind state --- 
+
+    reader_task = asyncio.create_task(_read_client_messages(websocket, connection_state))
+    inbox = connection_state["inbox"]
     try:
-        while True:
-            # Receive message from Electron client
-            data = await websocket.receive_text()
-            connection_key = str(websocket.client)
-            
-            # --- Retrieve connection state --- 
-            connection_state = ACTIVE_CONNECTIONS.get(connection_key)
-            if not connection_state:
-                print(f"[WebSocket Error] Received message from unknown connection: {connection_key}. Closing.")
-                await websocket.close(code=1011)
-                break # Exit the while loop
-                
-            agent = connection_state["agent"]
-            chat_id = connection_state["chat_id"] # Get chat_id for logging
-            current_total_cost = connection_state["total_cost"] # Get current cost
-            # --- End retrieve state --- 
-            
-            print(f"WebSocket ({chat_id}) received: {data[:200]}...")
-            try:
-                message_data = json.loads(data)
-                message_type = message_data.get("type")
-
-                if message_type == "user_message":
-                    # ... (logic for getting text, screenshot, context remains same)
-                    text = message_data.get("text")
-                    screenshot_data_url = message_data.get("screenshot_data_url")
-                    context_text = message_data.get("context_text")
-                    
-                    if not text:
-                        await websocket.send_text(json.dumps({"type": "error", "content": "Missing text in user_message"}))
-                        continue
-                    
-                    print(f"[WebSocket ({chat_id})] Processing user_message: {text[:50]}...")
-                    
-                    # Check if this is the first message and set chat title
-                    if len(agent.memory) == 0:
-                        # Use first 50 chars of message as title, or up to first newline
-                        title = text.split('\n')[0][:50]
-                        if len(title) < len(text):
-                            title += "..."
-                        await update_chat_title_in_db(chat_id, title)
-                        print(f"[WebSocket ({chat_id})] Set initial chat title: {title}")
-                    
-                    # ... (logic for adding message to agent memory remains same, using retrieved agent) ...
-                    if agent.pending_ask_user_tool_call_id:
-                        tool_call_id = agent.pending_ask_user_tool_call_id
-                        agent.add_message_to_memory(role="tool", tool_call_id=tool_call_id, content=text)
-                        await save_message_to_db(chat_id=chat_id, role="tool", content=text, tool_call_id=tool_call_id)
-                        agent.pending_ask_user_tool_call_id = None
-                    else:
-                        # ... prepare user content ...
-                        final_text_content = text
-                        if context_text and context_text.strip(): 
-                            final_text_content = f"Based on this context:\n```\n{context_text}\n```\n\n{text}"
-                        user_content: List[Dict[str, Any]] = [{"type": "text", "text": final_text_content}]
-                        if screenshot_data_url:
-                            user_content.append({
-                                "type": "image_url",
-                                "image_url": {"url": screenshot_data_url}
-                            })
-                        agent.add_message_to_memory(role="user", content=user_content)
-                        await save_message_to_db(chat_id=chat_id, role="user", content=user_content)
-                    
-                    # --- Run the agent step (using retrieved agent) --- 
-                    api_keys_for_step = connection_state.get("api_keys", {}) # Get session keys
-                    agent_finished_turn, step_cost = await run_agent_step_and_send(
-                        agent, websocket, PENDING_AGENT_QUESTIONS, 
-                        api_keys=api_keys_for_step, # Pass keys
-                        connection_state=connection_state # Pass connection state
-                    )
-                    if step_cost is not None:
-                        connection_state["total_cost"] += step_cost
-                        new_total_cost = connection_state["total_cost"]
-                        # --- Update DB --- 
-                        await update_chat_metadata_in_db(chat_id, total_cost=new_total_cost)
-                        # --- End DB Update --- 
-                        print(f"[WebSocket ({chat_id})] LLM call cost: ${step_cost:.6f}, Session total: ${new_total_cost:.6f}")
-                        await websocket.send_text(json.dumps({
-                            "type": "cost_update",
-                            "total_cost": new_total_cost
-                        }))
-                    else:
-                        print(f"[WebSocket ({chat_id}) WARNING] Agent step finished but no cost was returned.")
-                        
-                elif message_type == "tool_result":
-                    # ... (logic for getting results remains same) ...
-                    results = message_data.get("results")
-                    if not results or not isinstance(results, list): 
-                        await websocket.send_text(json.dumps({"type": "error", "content": "Missing or invalid results in tool_result message"}))
-                        continue
-                        
-                    print(f"[WebSocket ({chat_id})] Processing tool_result for {len(results)} tool(s)...")
-                    
-                    # Track which tool calls have been responded to
-                    received_tool_call_ids = set()
-                    expected_tool_call_ids = set()
-                    
-                    # Find the most recent assistant message with tool calls
-                    for msg in reversed(agent.memory):
-                        if msg.get("role") == "assistant" and msg.get("tool_calls"):
-                            for tool_call in msg["tool_calls"]:
-                                expected_tool_call_ids.add(tool_call["id"])
-                            break
-                    
-                    # Add the received results to memory
-                    for result in results:
-                        tool_call_id = result.get("tool_call_id")
-                        content = str(result.get("content", ""))
-                        if tool_call_id:
-                            agent.add_message_to_memory(role="tool", tool_call_id=tool_call_id, content=content)
-                            await save_message_to_db(chat_id=chat_id, role="tool", content=content, tool_call_id=tool_call_id)
-                            received_tool_call_ids.add(tool_call_id)
-                        else:
-                            print(f"[WebSocket ({chat_id}) WARNING] Received tool_result missing tool_call_id")
-                    
-                    # Check if we have all expected tool results
-                    missing_tool_calls = expected_tool_call_ids - received_tool_call_ids
-                    if missing_tool_calls:
-                        print(f"[WebSocket ({chat_id})] Still waiting for tool results: {missing_tool_calls}")
-                        continue  # Don't proceed with agent step until we have all results
-                     
-                    print(f"[WebSocket ({chat_id}) DEBUG] Agent memory AFTER adding tool results:")
-                    print(json.dumps(agent.memory, indent=2))
-                    
-                    # --- Run agent step again (using retrieved agent) --- 
-                    print(f"[WebSocket ({chat_id})] All tool results received. Triggering agent step...")
-                    api_keys_for_step = connection_state.get("api_keys", {}) # Get session keys
-                    agent_finished_turn, step_cost = await run_agent_step_and_send(
-                        agent, websocket, PENDING_AGENT_QUESTIONS, 
-                        api_keys=api_keys_for_step, # Pass keys
-                        connection_state=connection_state # Pass connection state
-                    )
-                    if step_cost is not None:
-                        connection_state["total_cost"] += step_cost
-                        new_total_cost = connection_state["total_cost"]
-                        # --- Update DB --- 
-                        await update_chat_metadata_in_db(chat_id, total_cost=new_total_cost)
-                        # --- End DB Update --- 
-                        print(f"[WebSocket ({chat_id})] LLM call cost: ${step_cost:.6f}, Session total: ${new_total_cost:.6f}")
-                        await websocket.send_text(json.dumps({
-                            "type": "cost_update",
-                            "total_cost": new_total_cost
-                        }))
-                    else:
-                        print(f"[WebSocket ({chat_id}) WARNING] Agent step finished but no cost was returned.")
-                    
-                elif message_type == "user_response":
-                    # ... (logic for getting request_id, answer remains same) ...
-                    request_id = message_data.get("request_id")
-                    answer = message_data.get("answer")
-                    if not request_id or answer is None: 
-                        await websocket.send_text(json.dumps({"type": "error", "content": "Missing request_id or answer in user_response"}))
-                        continue
-
-                    print(f"[WebSocket ({chat_id})] Processing user_response for request_id: {request_id}")
-                    # --- Use connection_key for PENDING_AGENT_QUESTIONS --- 
-                    future = PENDING_AGENT_QUESTIONS.get(connection_key, {}).get(request_id)
-
-                    if future and not future.done():
-                        print(f"[WebSocket ({chat_id})] Found pending future for {request_id}. Setting result.")
-                        future.set_result(answer) 
-                    elif future and future.done():
-                        print(f"[WebSocket ({chat_id}) WARNING] Received user_response for already completed request_id: {request_id}")
-                    else:
-                        print(f"[WebSocket ({chat_id}) WARNING] Received user_response for unknown or expired request_id: {request_id} for connection {connection_key}")
-                        await websocket.send_text(json.dumps({"type": "warning", "content": f"Received response for unknown or expired request ID {request_id}."}))
-                    # --- End user_response handling --- 
-                    
-                elif message_type == "set_llm_model":
-                    # ... (logic for getting model_name remains same) ...
-                    model_name = message_data.get("model_name")
-                    if model_name and isinstance(model_name, str):
-                        print(f"[WebSocket ({chat_id})] Received request to set model to: {model_name}")
-                        agent.set_model(model_name) # Use retrieved agent
-                        # --- Update DB --- 
-                        current_total_cost = connection_state["total_cost"] # Get current cost from connection state
-                        await update_chat_metadata_in_db(chat_id, total_cost=current_total_cost, current_model=model_name)
-                        # --- End DB Update --- 
-                    else:
-                        print(f"[WebSocket ({chat_id}) WARNING] Received invalid set_llm_model message: {message_data}")
-                        await websocket.send_text(json.dumps({"type": "error", "content": "Invalid or missing model_name in set_llm_model message"}))
-                
-                # --- NEW: Handle set_api_keys --- 
-                elif message_type == "set_api_keys":
-                    keys_data = message_data.get("keys")
-                    if isinstance(keys_data, dict):
-                        print(f"[WebSocket ({chat_id})] Received request to set API keys.")
-                        # Validate keys (basic validation)
-                        validated_keys = {k: v for k, v in keys_data.items() if isinstance(k, str) and isinstance(v, str)}
-                        connection_state["api_keys"] = validated_keys # Update the connection state
-                        print(f"[WebSocket ({chat_id})] Updated API keys for session: {list(validated_keys.keys())}")
-                        # Optional: Send confirmation back to client
-                        await websocket.send_text(json.dumps({"type": "info", "content": f"API keys received for providers: {list(validated_keys.keys())}"}))
-                    else:
-                         print(f"[WebSocket ({chat_id}) WARNING] Received invalid set_api_keys message: {message_data}")
-                         await websocket.send_text(json.dumps({"type": "error", "content": "Invalid or missing 'keys' dictionary in set_api_keys message"}))
-                # --- End set_api_keys handling ---
-                
-                elif message_type == "audio_input":
-                    # ... (logic for getting audio data, format remains same) ...
-                    audio_data_base64 = message_data.get("audio_data")
-                    audio_format = message_data.get("format", "webm")
-                    if not audio_data_base64:
-                        await websocket.send_text(json.dumps({"type": "error", "content": "Missing audio_data in audio_input message"}))
-                        continue
-                    
-                    print(f"[WebSocket ({chat_id})] Processing audio_input (format: {audio_format})...")
-                    # ... (transcription call and error handling remain same) ...
-                    try:
-                        transcription_text = await get_transcription(audio_data_base64, audio_format)
-                        print(f"[WebSocket ({chat_id})] Transcription successful: '{transcription_text[:100]}...'")
-                        await websocket.send_text(json.dumps({
-                            "type": "transcription_result",
-                            "text": transcription_text
-                        }))
-                        print(f"[WebSocket ({chat_id})] Sent transcription_result to client.")
-                    except HTTPException as http_exc:
-                        print(f"[WebSocket ({chat_id}) Error] Transcription HTTP Exception: {http_exc.detail}")
-                        await websocket.send_text(json.dumps({"type": "error", "content": f"Transcription Error: {http_exc.detail}"}))
-                    except Exception as trans_exc:
-                        print(f"[WebSocket ({chat_id}) Error] Unexpected error during transcription processing: {trans_exc}")
-                        traceback.print_exc()
-                        await websocket.send_text(json.dumps({"type": "error", "content": f"Unexpected transcription error: {trans_exc}"}))
-                
-                elif message_type == "stop":
-                    print(f"[WebSocket ({chat_id})] Received stop request")
-                    connection_state["stop_requested"] = True
-                    
-                    # Send acknowledgment back to client
-                    await websocket.send_text(json.dumps({"type": "info", "content": "Stop request received"}))
-                    # Note: The actual stopping and tool cancellation will happen in the websocket handler
-                    
-                    # Reset the stop_requested flag after handling the stop request
-                    connection_state["stop_requested"] = False
-                    print(f"[WebSocket ({chat_id})] Reset stop_requested flag")
-                
-                else:
-                    print(f"[WebSocket ({chat_id}) WARNING] Invalid message type received: {message_type}")
-                    await websocket.send_text(json.dumps({"type": "error", "content": f"Invalid message type received: {message_type}"}))
+        # Handle queued messages in order; None means the client disconnected
+        while (message_data := await inbox.get()) is not None:
+            await _dispatch_message(websocket, connection_state, message_data)
+        await reader_task # Re-raises whatever ended the reader, if it failed
 
-            except json.JSONDecodeError:
-                print(f"WebSocket ({chat_id}) received invalid JSON")
-                await websocket.send_text(json.dumps({"type": "error", "content": "Invalid JSON received"}))
-            except Exception as e:
-                print(f"Error processing message via WebSocket ({chat_id}) (see traceback below):")
-                traceback.print_exc() 
-                error_message = str(e)
-                await websocket.send_text(json.dumps({"type": "error", "content": f"Error processing request: {error_message}"}))
-
-    except WebSocketDisconnect:
+        print(f"WebSocket connection closed for {connection_key} (chat_id: {chat_id}).")
+    except WebSocketDisconnect: # Raised when a send hits an already-closed socket
         print(f"WebSocket connection closed for {connection_key} (chat_id: {chat_id}).")
     except Exception as e:
         print(f"Unexpected WebSocket error for {connection_key} (chat_id: {chat_id}) (see traceback below):")
         traceback.print_exc()
         try:
-            await websocket.send_text(json.dumps({"type": "error", "content": f"Unexpected WebSocket error"}))
+            await websocket.send_bytes(_ERR_UNEXPECTED)
             await websocket.close(code=1011)
         except RuntimeError:
             pass # Already closed
     finally:
-        # --- Remove connection state --- 
-        if connection_key in ACTIVE_CONNECTIONS:
-            removed_chat_id = ACTIVE_CONNECTIONS[connection_key].get("chat_id", "unknown")
-            del ACTIVE_CONNECTIONS[connection_key]
-            print(f"Removed connection state for {connection_key} (chat_id: {removed_chat_id}). Active connections: {len(ACTIVE_CONNECTIONS)}")
-        # --- End remove connection state ---
-
-        # --- Cleanup agent questions for this connection (using connection_key) ---
-        if connection_key in PENDING_AGENT_QUESTIONS: # Use connection_key matching ACTIVE_CONNECTIONS
-            print(f"[WebSocket Cleanup] Cleaning up pending questions for connection {connection_key} on disconnect.")
-            for request_id, future in PENDING_AGENT_QUESTIONS[connection_key].items():
-                if not future.done():
-                    future.cancel("WebSocket connection closed.")
-            del PENDING_AGENT_QUESTIONS[connection_key]
-        # --- End Cleanup ---
+        reader_task.cancel()
+        await _release_connection(connection_key)
 
 @app.get("/") # Basic root endpoint for testing
 async def read_root():
@@ -447,8 +672,7 @@ async def list_chats():
     chats = []
     try:
         print("[/chats] Fetching last 10 chats...")
-        async with aiosqlite.connect(DATABASE_URL) as db:
-            db.row_factory = aiosqlite.Row # Access columns by name
+        async with db_pool.acquire() as db:
             async with db.execute(
                 "SELECT title, chat_id, last_active_at FROM chats ORDER BY last_active_at DESC LIMIT 25"
             ) as cursor:
@@ -1,20 +1,115 @@
 """WebSocket handler for agent interactions."""
 
 import os
-import json
-import traceback
+import logging
 import asyncio
 import uuid
-from fastapi import WebSocket, HTTPException
-from core.agent.agent import ChatAgent 
+from dataclasses import dataclass
+from fastapi import WebSocket, WebSocketDisconnect, HTTPException
+from core.agent.agent import ChatAgent, STEP_TEXT, STEP_TOOL_CALLS, STEP_TOOL_PARTIAL, STEP_ERROR, STEP_COST
 from typing import List, Dict, Any, Callable, Tuple, Optional
 # --- Import Server Tool Registry --- 
-from core.tools.base import SERVER_EXECUTABLE_TOOLS, execute_browser_task 
+from core.tools.base import SERVER_EXECUTABLE_TOOLS, CLIENT_EXECUTABLE_TOOLS, ServerTool, ToolContext 
+from utils.json_utils import dumps_bytes, loads
+from app.websocket.outbox import Outbox, END_FRAME
+from app.config import get_settings
+from db.operations import save_messages_to_db
 # --- Import state potentially needed by tools ---
 # This creates a potential circular dependency if tools also import this.
 # Consider passing necessary state (like PENDING_AGENT_QUESTIONS) as arguments instead.
 # from main import PENDING_AGENT_QUESTIONS # REMOVED: Avoid circular import
 
+logger = logging.getLogger(__name__)
+
+# --- Tool Categories ---
+# Where each known tool runs, looked up once per call instead of testing each category in turn
+_UNKNOWN_TOOL, _SERVER_TOOL, _CLIENT_TOOL, _ASK_USER_TOOL, _TERMINATE_TOOL = range(5)
+_TOOL_KINDS: Dict[str, int] = {
+    **{name: _SERVER_TOOL for name in SERVER_EXECUTABLE_TOOLS},
+    **{name: _CLIENT_TOOL for name in CLIENT_EXECUTABLE_TOOLS},
+    "ask_user": _ASK_USER_TOOL,
+    "terminate": _TERMINATE_TOOL,
+}
+# --- End Tool Categories ---
+
+# --- Server Tool Execution ---
+def _tool_arguments(tool_call: Dict[str, Any], parsed_arguments: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Returns the call's arguments, reusing the dict the agent already parsed when there is one."""
+    arguments = parsed_arguments.get(tool_call["id"])
+    return arguments if arguments is not None else loads(tool_call["function"]["arguments"])
+
+@dataclass(slots=True)
+class _ServerCall:
+    """A server tool call with its id, name and function resolved once, during categorization."""
+    id: str
+    name: str
+    function: ServerTool
+    arguments: Optional[Dict[str, Any]] # Already parsed by the agent, if it had them
+    raw_arguments: str # JSON text, parsed only when arguments is None
+
+async def _run_server_tool(call: _ServerCall, ctx: ToolContext) -> Tuple[str, Any]:
+    """Runs one server-side tool call and returns (tool_call_id, result). Failures are returned as the
+    result text rather than raised, so one failing tool doesn't cancel the others running alongside it.
+    """
+    try:
+        arguments = call.arguments if call.arguments is not None else loads(call.raw_arguments)
+        return call.id, await call.function(ctx, **arguments)
+    except Exception as e:
+        logger.exception("[WebSocket Error] Server tool %s failed", call.name)
+        return call.id, f"Error executing tool {call.name}: {str(e)}"
+# --- End Server Tool Execution ---
+
+# --- Fixed Frames ---
+# Stop acknowledgements never change, so they are encoded once (END_FRAME lives with the outbox)
+_STOP_INFO_FRAME = dumps_bytes({"type": "info", "content": "Operation stopped by user request."})
+_TOOL_INTERRUPT_FRAME = dumps_bytes({"type": "info", "content": "Tool execution interrupted by user request."})
+_ERR_NO_TOOLS_FRAME = dumps_bytes({"type": "error", "content": "Agent requested tool call but sent no tools."})
+# --- End Fixed Frames ---
+
+# --- Client Tool Call Frames ---
+def _tool_call_partial_frame(item: Dict[str, Any], encoded_call: bytes) -> bytes:
+    return b'{"type":"tool_call_partial","index":' + str(item["index"]).encode() + b',"call":' + encoded_call + b'}'
+
+def _tool_call_request_frame(tool_calls: List[Dict[str, Any]], announced_calls: Dict[str, Tuple[Dict[str, Any], bytes]]) -> bytes:
+    """Encodes a tool_call_request, reusing the bytes sent in a call's tool_call_partial if the call is unchanged."""
+    encoded_calls = []
+    for call in tool_calls:
+        announced = announced_calls.get(call["id"])
+        if announced is not None and announced[0]["function"] == call["function"]:
+            encoded_calls.append(announced[1])
+        else:
+            encoded_calls.append(dumps_bytes(call))
+    return b'{"type":"tool_call_request","tool_calls":[' + b",".join(encoded_calls) + b']}'
+# --- End Client Tool Call Frames ---
+
+# --- Client Replies ---
+async def _next_client_messages(websocket: WebSocket, connection_state: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Waits for the next tool_result and returns it along with any already queued behind it, or
+    returns nothing once a stop is requested. While this waits, the connection's reader routes
+    tool results to its tool_results queue; without connection state the socket is read directly.
+    """
+    if connection_state is None:
+        return [loads(await websocket.receive_text())]
+    tool_results: "asyncio.Queue[Optional[Dict[str, Any]]]" = connection_state["tool_results"]
+    connection_state["awaiting_tool_results"] = True
+    get_result = asyncio.ensure_future(tool_results.get())
+    stop_requested = asyncio.ensure_future(connection_state["stop_event"].wait())
+    try:
+        await asyncio.wait((get_result, stop_requested), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        connection_state["awaiting_tool_results"] = False
+        stop_requested.cancel()
+        got_result = get_result.done()
+        if not got_result:
+            get_result.cancel()
+    messages = [get_result.result()] if got_result else []
+    while not tool_results.empty():
+        messages.append(tool_results.get_nowait())
+    if None in messages: # The reader's end-of-stream marker: leave it for the connection loop too
+        raise WebSocketDisconnect()
+    return messages
+# --- End Client Replies ---
+
 # --- Helper function to run agent step and handle output --- 
 async def run_agent_step_and_send(
     agent: ChatAgent, 
@@ -23,351 +118,293 @@ async def run_agent_step_and_send(
     api_keys: Optional[Dict[str, str]] = None,
     connection_state: Optional[Dict[str, Any]] = None  # Add connection state parameter
 ) -> Tuple[bool, Optional[float]]:
+    """Run agent steps until the turn is handed back to the user, sending results via websocket.
+    Returns (finished_turn: bool, cost: Optional[float]), the cost summed over every step that ran.
+    """
+    # Sends go through the connection's outbox; a caller without one gets an outbox for this turn only
+    outbox = connection_state.get("outbox") if connection_state else None
+    owns_outbox = outbox is None
+    if owns_outbox:
+        outbox = Outbox(websocket)
+    total_cost: Optional[float] = None
+    try:
+        while True:
+            finished_turn, step_cost, needs_another_step = await _one_pass(
+                agent, websocket, outbox, pending_questions, api_keys, connection_state
+            )
+            if step_cost is not None:
+                total_cost = step_cost if total_cost is None else total_cost + step_cost
+            if not needs_another_step:
+                break
+        await outbox.flush() # The caller sends directly (e.g. cost_update) and must not overtake queued frames
+    except Exception as e:
+        print(f"[WebSocket Error] Failed to send queued messages: {e}")
+        finished_turn = False
+    finally:
+        if owns_outbox:
+            await outbox.close()
+    return finished_turn, total_cost
+
+async def _one_pass(
+    agent: ChatAgent, 
+    websocket: WebSocket, 
+    outbox: Outbox,
+    pending_questions: Dict[str, Dict[str, asyncio.Future]],
+    api_keys: Optional[Dict[str, str]],
+    connection_state: Optional[Dict[str, Any]]
+) -> Tuple[bool, Optional[float], bool]:
     """Run one step of agent interaction and send results via websocket.
-    Returns (finished_turn: bool, cost: Optional[float])
+    Returns (finished_turn: bool, cost: Optional[float], needs_another_step: bool)
     """
     stream_ended = False
     final_cost_from_agent = None
+    announced_calls: Dict[str, Tuple[Dict[str, Any], bytes]] = {} # Client calls sent as tool_call_partial: id -> (call, its JSON)
+    stop_event = connection_state["stop_event"] if connection_state else asyncio.Event() # Never set without a connection
     
     try:
-        async for item in agent.step(api_keys=api_keys, connection_state=connection_state):
+        async for kind, item in agent.step(api_keys=api_keys, connection_state=connection_state):
             # Check for stop signal
-            if connection_state and connection_state.get("stop_requested"):
+            if stop_event.is_set():
                 print("[WebSocket] Stop requested, ending agent step")
                 # If there are any tool calls in the last assistant message, add cancellation responses
-                for msg in reversed(agent.memory):
-                    if msg.get("role") == "assistant" and msg.get("tool_calls"):
-                        for tool_call in msg["tool_calls"]:
-                            tool_id = tool_call["id"]
-                            # Only add cancellation response if there isn't already a response for this tool
-                            if not any(m.get("tool_call_id") == tool_id for m in agent.memory if m.get("role") == "tool"):
-                                cancellation_content = f"Tool execution cancelled: Operation interrupted by user"
-                                agent.add_message_to_memory(
-                                    role="tool",
-                                    content=cancellation_content,
-                                    tool_call_id=tool_id
-                                )
-                        break  # Only handle the most recent assistant message
+                for tool_call in agent.last_tool_calls():
+                    tool_id = tool_call["id"]
+                    # Only add cancellation response if there isn't already a response for this tool
+                    if not agent.has_tool_response(tool_id):
+                        cancellation_content = f"Tool execution cancelled: Operation interrupted by user"
+                        agent.add_message_to_memory(
+                            role="tool",
+                            content=cancellation_content,
+                            tool_call_id=tool_id
+                        )
                 
-                await websocket.send_text(json.dumps({
-                    "type": "info",
-                    "content": "Operation stopped by user request."
-                }))
-                await websocket.send_text(json.dumps({"type": "end", "content": ""}))
-                return True, final_cost_from_agent
+                outbox.put_nowait(_STOP_INFO_FRAME)
+                outbox.put_nowait(END_FRAME)
+                return True, final_cost_from_agent, False
 
-            if isinstance(item, tuple) and item[0] == "final_cost":
-                final_cost_from_agent = item[1]
+            if kind == STEP_COST:
+                final_cost_from_agent = item
                 print(f"[run_agent_step_and_send] Captured final_cost: {final_cost_from_agent}")
                 continue
 
-            if isinstance(item, str):
-                await websocket.send_text(json.dumps({"type": "chunk", "content": item}))
-            elif isinstance(item, dict):
-                if item.get("type") == "tool_call_request":
-                    tool_calls = item.get("tool_calls", [])
-                    if not tool_calls:
-                        print("[WebSocket WARNING] Received tool_call_request with no tool_calls")
-                        await websocket.send_text(json.dumps({"type": "error", "content": "Agent requested tool call but sent no tools."}))
-                        stream_ended = True
-                        break
+            if kind == STEP_TEXT:
+                outbox.put_nowait({"type": "chunk", "content": item})
+            elif kind == STEP_TOOL_CALLS:
+                tool_calls = item.get("tool_calls", [])
+                parsed_arguments = item.get("parsed_arguments", {}) # By call id, when the agent already parsed them
+                if not tool_calls:
+                    print("[WebSocket WARNING] Received tool_call_request with no tool_calls")
+                    outbox.put_nowait(_ERR_NO_TOOLS_FRAME)
+                    stream_ended = True
+                    break
 
-                    # Track all pending tool calls
-                    pending_tool_calls: Dict[str, Dict] = {}
-                    server_tool_calls: List[Dict] = []
-                    client_tool_calls: List[Dict] = []
+                # Track all pending tool calls
+                pending_tool_calls: Dict[str, Dict] = {}
+                server_tool_calls: List[_ServerCall] = []
+                client_tool_calls: List[Dict] = []
 
-                    # Categorize tool calls
-                    for tool_call in tool_calls:
-                        tool_name = tool_call.get("function", {}).get("name")
-                        call_id = tool_call["id"]
+                # Categorize tool calls
+                for tool_call in tool_calls:
+                    tool_name = tool_call["function"]["name"]
+                    call_id = tool_call["id"]
+                    tool_kind = _TOOL_KINDS.get(tool_name, _UNKNOWN_TOOL)
                         
-                        if tool_name in SERVER_EXECUTABLE_TOOLS:
-                            server_tool_calls.append(tool_call)
-                        elif tool_name in ["run_bash_command", "read_file", "edit_file", "paste_at_cursor"]:
-                            client_tool_calls.append(tool_call)
-                            pending_tool_calls[call_id] = tool_call
-                        elif tool_name == "ask_user":
-                            if call_id:
-                                agent.pending_ask_user_tool_call_id = call_id
-                                print(f"[WebSocket] Stored pending ask_user ID: {call_id}")
-                            question = json.loads(tool_call["function"]["arguments"]).get("question", "")
-                            await websocket.send_text(json.dumps({"type": "ask_user_request", "question": question}))
-                            stream_ended = True
-                            return True, final_cost_from_agent
-                        elif tool_name == "terminate":
-                            reason = json.loads(tool_call["function"]["arguments"]).get("reason", "Task finished.")
-                            await websocket.send_text(json.dumps({"type": "terminate_request", "reason": reason}))
-                            stream_ended = True
-                            return True, final_cost_from_agent
-                        else:
-                            print(f"[WebSocket WARNING] Unknown tool requested: {tool_name}")
-                            continue
+                    if tool_kind == _SERVER_TOOL:
+                        server_tool_calls.append(_ServerCall(
+                            call_id, tool_name, SERVER_EXECUTABLE_TOOLS[tool_name],
+                            parsed_arguments.get(call_id), tool_call["function"]["arguments"]
+                        ))
+                    elif tool_kind == _CLIENT_TOOL:
+                        client_tool_calls.append(tool_call)
+                        pending_tool_calls[call_id] = tool_call
+                    elif tool_kind == _ASK_USER_TOOL:
+                        if call_id:
+                            agent.pending_ask_user_tool_call_id = call_id
+                            print(f"[WebSocket] Stored pending ask_user ID: {call_id}")
+                        question = _tool_arguments(tool_call, parsed_arguments).get("question", "")
+                        outbox.put_nowait({"type": "ask_user_request", "question": question})
+                        stream_ended = True
+                        return True, final_cost_from_agent, False
+                    elif tool_kind == _TERMINATE_TOOL:
+                        reason = _tool_arguments(tool_call, parsed_arguments).get("reason", "Task finished.")
+                        outbox.put_nowait({"type": "terminate_request", "reason": reason})
+                        stream_ended = True
+                        return True, final_cost_from_agent, False
+                    else:
+                        print(f"[WebSocket WARNING] Unknown tool requested: {tool_name}")
+                        continue
 
-                    # Handle server-side tools first
-                    for tool_call in server_tool_calls:
-                        tool_name = tool_call["function"]["name"]
-                        tool_call_id = tool_call["id"]
-                        arguments = tool_call["function"]["arguments"]
-                        
-                        try:
-                            parsed_args = json.loads(arguments)
-                            server_function = SERVER_EXECUTABLE_TOOLS[tool_name]
-                            
-                            if server_function is execute_browser_task:
-                                task_arg = parsed_args.get('task')
-                                if task_arg:
-                                    result_content = await execute_browser_task(
-                                        task=task_arg,
-                                        websocket=websocket,
-                                        websocket_id=str(websocket.client),
-                                        pending_questions_dict=pending_questions
-                                    )
-                                else:
-                                    result_content = "Error: Missing 'task' argument for browser_user tool."
-                            else:
-                                result_content = await server_function(**parsed_args)
-                                
-                            agent.add_message_to_memory(
-                                role="tool",
-                                tool_call_id=tool_call_id,
-                                content=result_content
-                            )
-                        except Exception as e:
-                            print(f"[WebSocket Error] Server tool execution failed: {e}")
-                            traceback.print_exc()
-                            agent.add_message_to_memory(
-                                role="tool",
-                                tool_call_id=tool_call_id,
-                                content=f"Error executing tool {tool_name}: {str(e)}"
-                            )
+                # Remember what the client owes us, so a tool_result handled outside this step needs no memory scan
+                if connection_state:
+                    connection_state["requested_tool_calls"] = tool_calls
+                    connection_state["expected_tool_call_ids"] = set(pending_tool_calls)
+                    connection_state["started_tool_call_ids"].clear() # Cleared before the request goes out, so no ack is lost
+
+                # Handle server-side tools first; they are independent, so run them concurrently
+                if server_tool_calls:
+                    await outbox.flush() # Browser tasks send on the socket directly; keep them after queued frames
+                    tool_ctx = connection_state["tool_context"] if connection_state else ToolContext(websocket, str(websocket.client), pending_questions)
+                    server_results = await asyncio.gather(
+                        *(_run_server_tool(call, tool_ctx) for call in server_tool_calls)
+                    )
+                    for tool_call_id, result_content in server_results: # gather keeps the call order
+                        agent.add_message_to_memory(
+                            role="tool",
+                            tool_call_id=tool_call_id,
+                            content=result_content
+                        )
 
-                    # Send client-side tool calls if any
-                    if client_tool_calls:
-                        # Add tool calls to tracking set
-                        if connection_state:
-                            connection_state["current_tool_calls"].update(call["id"] for call in client_tool_calls)
+                # Send client-side tool calls if any
+                if client_tool_calls:
+                    # Add tool calls to tracking set
+                    if connection_state:
+                        connection_state["current_tool_calls"].update(pending_tool_calls) # Keyed by the client calls' ids
                         
-                        await websocket.send_text(json.dumps({
-                            "type": "tool_call_request",
-                            "tool_calls": client_tool_calls
-                        }))
+                    outbox.put_nowait(_tool_call_request_frame(client_tool_calls, announced_calls))
                         
-                        # Wait for all client tool responses or stop signal
-                        while pending_tool_calls:
-                            try:
-                                # Check for stop signal before waiting for response
-                                if connection_state and connection_state.get("stop_requested"):
-                                    print("[WebSocket] Stop requested while waiting for tool results")
-                                    # Only add cancellation responses for tool calls that haven't received responses yet
-                                    for tool_id, tool_call in pending_tool_calls.items():
-                                        # Skip if this tool call already has a response in agent memory
-                                        if any(m.get("tool_call_id") == tool_id for m in agent.memory if m.get("role") == "tool"):
-                                            print(f"[WebSocket] Tool {tool_id} already has response, skipping cancellation")
-                                            continue
+                    # Wait for all client tool responses or stop signal
+                    while pending_tool_calls:
+                        try:
+                            # Check for stop signal before waiting for response
+                            if stop_event.is_set():
+                                print("[WebSocket] Stop requested while waiting for tool results")
+                                # Only add cancellation responses for tool calls that haven't received responses yet
+                                cancelled_rows = [] # Saved together below, in one transaction
+                                for tool_id, tool_call in pending_tool_calls.items():
+                                    # Skip if this tool call already has a response in agent memory
+                                    if agent.has_tool_response(tool_id):
+                                        print(f"[WebSocket] Tool {tool_id} already has response, skipping cancellation")
+                                        continue
                                             
-                                        print(f"[WebSocket] Adding cancellation response for tool {tool_id}")
-                                        cancellation_content = f"Tool execution cancelled: Operation interrupted by user"
-                                        # Add to agent memory
-                                        agent.add_message_to_memory(
-                                            role="tool",
-                                            content=cancellation_content,
-                                            tool_call_id=tool_id
-                                        )
-                                        # Save to database
-                                        chat_id = connection_state.get("chat_id")
-                                        if chat_id:
-                                            from main import save_message_to_db  # Import at use to avoid circular imports
-                                            await save_message_to_db(
-                                                chat_id=chat_id,
-                                                role="tool",
-                                                content=cancellation_content,
-                                                tool_call_id=tool_id
-                                            )
-                                        # Remove from tracking
-                                        if connection_state:
-                                            connection_state["current_tool_calls"].discard(tool_id)
-                                    pending_tool_calls.clear()  # Clear after handling all pending calls
+                                    print(f"[WebSocket] Adding cancellation response for tool {tool_id}")
+                                    cancellation_content = f"Tool execution cancelled: Operation interrupted by user"
+                                    # Add to agent memory
+                                    agent.add_message_to_memory(
+                                        role="tool",
+                                        content=cancellation_content,
+                                        tool_call_id=tool_id
+                                    )
+                                    cancelled_rows.append(("tool", cancellation_content, tool_id))
+                                    # Remove from tracking
+                                    if connection_state:
+                                        connection_state["current_tool_calls"].discard(tool_id)
+                                # Save to database
+                                chat_id = connection_state.get("chat_id")
+                                if chat_id and cancelled_rows:
+                                    await save_messages_to_db(chat_id, cancelled_rows)
+                                pending_tool_calls.clear()  # Clear after handling all pending calls
+                                if connection_state:
+                                    connection_state["expected_tool_call_ids"].clear()
+                                    connection_state["started_tool_call_ids"].clear()
                                     
-                                    await websocket.send_text(json.dumps({"type": "info", "content": "Tool execution interrupted by user request."}))
-                                    await websocket.send_text(json.dumps({"type": "end", "content": ""}))
-                                    return True, final_cost_from_agent
+                                outbox.put_nowait(_TOOL_INTERRUPT_FRAME)
+                                outbox.put_nowait(END_FRAME)
+                                return True, final_cost_from_agent, False
 
-                                response = await websocket.receive_text()
-                                response_data = json.loads(response)
-                                
-                                if response_data.get("type") == "tool_result":
-                                    results = response_data.get("results", [])
-                                    for result in results:
-                                        tool_call_id = result.get("tool_call_id")
-                                        if tool_call_id in pending_tool_calls:
-                                            content = str(result.get("content", ""))
-                                            agent.add_message_to_memory(
-                                                role="tool",
-                                                content=content,
-                                                tool_call_id=tool_call_id
-                                            )
-                                            del pending_tool_calls[tool_call_id]
-                                            # Remove from tracking set
-                                            if connection_state:
-                                                connection_state["current_tool_calls"].discard(tool_call_id)
-                                            # If this was a denial, trigger next agent step
-                                            if "User denied execution" in content:
-                                                print("[WebSocket] Tool execution denied, triggering next agent step")
-                                                agent_finished, cost_from_nested = await run_agent_step_and_send(
-                                                    agent, websocket, pending_questions, 
-                                                    api_keys=api_keys,
-                                                    connection_state=connection_state
-                                                )
-                                                return agent_finished, final_cost_from_agent if final_cost_from_agent is not None else cost_from_nested
-                            except Exception as e:
-                                print(f"Error processing tool response: {e}")
-                                # Clean up tracking on error
-                                if connection_state:
-                                    for tool_id in pending_tool_calls:
+                            # The timeout only runs once every pending call is executing: time the user spends
+                            # on the approval prompt is not the client going quiet (a disconnect ends the wait anyway)
+                            started_ids = connection_state["started_tool_call_ids"] if connection_state else None
+                            reply_timeout = get_settings().client_reply_timeout if started_ids is None or started_ids.issuperset(pending_tool_calls) else None
+                            try:
+                                responses = await asyncio.wait_for(
+                                    _next_client_messages(websocket, connection_state), timeout=reply_timeout
+                                )
+                            except asyncio.TimeoutError:
+                                # The client went quiet: answer the outstanding calls with an error so the agent can move on
+                                print(f"[WebSocket] Timed out waiting for tool results: {list(pending_tool_calls)}")
+                                timed_out_rows = [] # Saved together below, in one transaction
+                                for tool_id in pending_tool_calls:
+                                    agent.add_message_to_memory(
+                                        role="tool",
+                                        content="Error: client timed out",
+                                        tool_call_id=tool_id
+                                    )
+                                    timed_out_rows.append(("tool", "Error: client timed out", tool_id))
+                                    if connection_state:
                                         connection_state["current_tool_calls"].discard(tool_id)
+                                        connection_state["expected_tool_call_ids"].discard(tool_id)
+                                        connection_state["started_tool_call_ids"].discard(tool_id)
+                                chat_id = connection_state.get("chat_id") if connection_state else None
+                                if chat_id:
+                                    await save_messages_to_db(chat_id, timed_out_rows)
+                                pending_tool_calls.clear()
                                 break
 
-                    # If we had server tools, trigger next step
-                    if server_tool_calls:
-                        print("[WebSocket] Triggering next agent step after server tool execution...")
-                        agent_finished, cost_from_nested = await run_agent_step_and_send(
-                            agent, websocket, pending_questions, 
-                            api_keys=api_keys,
-                            connection_state=connection_state
-                        )
-                        return agent_finished, final_cost_from_agent if final_cost_from_agent is not None else cost_from_nested
+                            # Handle everything that arrived back-to-back in one pass
+                            denied = False
+                            for response_data in responses:
+                                if response_data.get("type") == "tool_call_started":
+                                    continue # Recorded by the reader; the next wait picks up the timeout
+                                if response_data.get("type") != "tool_result":
+                                    print(f"[WebSocket WARNING] Ignoring '{response_data.get('type')}' message while waiting for tool results")
+                                    continue
+                                for result in response_data.get("results", []):
+                                    tool_call_id = result.get("tool_call_id")
+                                    if pending_tool_calls.pop(tool_call_id, None) is None:
+                                        continue # Unknown or already answered
+                                    content = str(result.get("content", ""))
+                                    agent.add_message_to_memory(
+                                        role="tool",
+                                        content=content,
+                                        tool_call_id=tool_call_id
+                                    )
+                                    # Remove from tracking set
+                                    if connection_state:
+                                        connection_state["current_tool_calls"].discard(tool_call_id)
+                                        connection_state["expected_tool_call_ids"].discard(tool_call_id)
+                                        connection_state["started_tool_call_ids"].discard(tool_call_id)
+                                    if result["denied"] if "denied" in result else "User denied execution" in content: # Text check for clients without the flag
+                                        denied = True
+                            # If a call was denied, trigger next agent step
+                            if denied:
+                                print("[WebSocket] Tool execution denied, triggering next agent step")
+                                return True, final_cost_from_agent, True
+                        except Exception as e:
+                            print(f"Error processing tool response: {e}")
+                            # Clean up tracking on error
+                            if connection_state:
+                                for tool_id in pending_tool_calls:
+                                    connection_state["current_tool_calls"].discard(tool_id)
+                            break
 
-                    # If we only had client tools and they're all done, trigger next step
-                    if not server_tool_calls and not pending_tool_calls:
-                        print("[WebSocket] All client tools finished, triggering next agent step...")
-                        agent_finished, cost_from_nested = await run_agent_step_and_send(
-                            agent, websocket, pending_questions, 
-                            api_keys=api_keys,
-                            connection_state=connection_state
-                        )
-                        return agent_finished, final_cost_from_agent if final_cost_from_agent is not None else cost_from_nested
+                # If we had server tools, trigger next step
+                if server_tool_calls:
+                    print("[WebSocket] Triggering next agent step after server tool execution...")
+                    return True, final_cost_from_agent, True
 
-                elif item.get("type") == "error":
-                    await websocket.send_text(json.dumps(item))
-                    stream_ended = True
-                    break
+                # If we only had client tools and they're all done, trigger next step
+                if not server_tool_calls and not pending_tool_calls:
+                    print("[WebSocket] All client tools finished, triggering next agent step...")
+                    return True, final_cost_from_agent, True
+
+            elif kind == STEP_TOOL_PARTIAL:
+                # Early notice of a fully-formed call; the tool_call_request that follows is authoritative
+                call = item["call"]
+                if call["function"]["name"] in CLIENT_EXECUTABLE_TOOLS:
+                    encoded_call = dumps_bytes(call)
+                    announced_calls[call["id"]] = (call, encoded_call)
+                    outbox.put_nowait(_tool_call_partial_frame(item, encoded_call))
+
+            elif kind == STEP_ERROR:
+                outbox.put_nowait(item)
+                stream_ended = True
+                break
 
         if not stream_ended:
-            await websocket.send_text(json.dumps({"type": "end", "content": ""}))
+            outbox.put_nowait(END_FRAME)
             print("WebSocket sent stream end signal (agent step finished naturally).")
-            return True, final_cost_from_agent
+            return True, final_cost_from_agent, False
         else:
             print("WebSocket stream ended due to break, not sending duplicate 'end'.")
-            return True, final_cost_from_agent
+            return True, final_cost_from_agent, False
 
     except Exception as e:
-        print(f"Error during agent step execution or sending: {e}")
-        traceback.print_exc()
+        logger.exception("Error during agent step execution or sending")
         try:
-            await websocket.send_text(json.dumps({
+            outbox.put_nowait({
                 "type": "error",
                 "content": f"Error during agent processing: {str(e)}"
-            }))
+            })
         except Exception:
             pass
-        return False, final_cost_from_agent
-
-async def process_agent_response(self, agent: ChatAgent, connection_state: Dict) -> None:
-    """Process agent's response stream and handle tool calls."""
-    try:
-        async for response in agent.step(api_keys=self.api_keys, connection_state=connection_state):
-            # Check for stop signal at the start of each iteration
-            if connection_state.get("stop_requested"):
-                print("[WebSocket] Stop requested during agent processing")
-                # Send stop acknowledgment
-                await self.send_message({
-                    "type": "info",
-                    "content": "Operation stopped by user request."
-                })
-                await self.send_message({
-                    "type": "end",
-                    "content": ""
-                })
-                break
-
-            if isinstance(response, str):
-                # Handle content chunks
-                await self.send_message({
-                    "type": "content",
-                    "content": response
-                })
-            elif isinstance(response, dict):
-                # Handle tool calls
-                if response.get("type") == "tool_call":
-                    tool_call = response["tool_call"]
-                    tool_id = tool_call["id"]
-                    
-                    # Check for stop signal before executing tool
-                    if connection_state.get("stop_requested"):
-                        print("[WebSocket] Stop requested before tool execution")
-                        # Send stop acknowledgment
-                        await self.send_message({
-                            "type": "info",
-                            "content": "Operation stopped by user request."
-                        })
-                        await self.send_message({
-                            "type": "end",
-                            "content": ""
-                        })
-                        break
-                        
-                    # Execute tool and get result
-                    tool_result = await self.execute_tool(tool_call)
-                    
-                    # Check for stop signal after tool execution
-                    if connection_state.get("stop_requested"):
-                        print("[WebSocket] Stop requested after tool execution")
-                        # Send stop acknowledgment
-                        await self.send_message({
-                            "type": "info",
-                            "content": "Operation stopped by user request."
-                        })
-                        await self.send_message({
-                            "type": "end",
-                            "content": ""
-                        })
-                        break
-                        
-                    # Add tool result to agent's memory
-                    agent.add_message({
-                        "role": "tool",
-                        "tool_call_id": tool_id,
-                        "name": tool_call["name"],
-                        "content": tool_result
-                    })
-                    
-                    # Send tool result to client
-                    await self.send_message({
-                        "type": "tool_result",
-                        "tool_call_id": tool_id,
-                        "result": tool_result
-                    })
-                    
-                    # Continue processing with updated memory
-                    continue
-                elif isinstance(response, tuple) and response[0] == "final_cost":
-                    # Handle cost information
-                    await self.send_message({
-                        "type": "cost",
-                        "cost": response[1]
-                    })
-            
-        # Send end message if we haven't already (i.e., if we didn't break due to stop)
-        if not connection_state.get("stop_requested"):
-            await self.send_message({
-                "type": "end",
-                "content": ""
-            })
-            
-    except Exception as e:
-        print(f"[WebSocket] Error processing agent response: {str(e)}")
-        await self.send_message({
-            "type": "error",
-            "error": str(e)
-        })
\ No newline at end of file
+        return False, final_cost_from_agent, False
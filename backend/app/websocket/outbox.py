@@ -0,0 +1,127 @@
+"""Per-connection outgoing message queue, sent by a single writer task."""
+
+import asyncio
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Union
+
+from fastapi import WebSocket
+
+from utils.json_utils import dumps_bytes
+
+Message = Union[Dict[str, Any], bytes] # bytes are a frame that is already encoded
+
+# Fixed parts of the most frequent frames, encoded once
+_CHUNK_PREFIX = b'{"type":"chunk","content":'
+_CHUNK_SUFFIX = b'}'
+END_FRAME = dumps_bytes({"type": "end", "content": ""})
+_BATCH_PREFIX = b'{"type":"batch","frames":['
+_BATCH_SUFFIX = b']}'
+_BATCH_MAX_BYTES = 16384 # A batch frame is closed once it reaches this size
+
+
+def _chunk_frame(parts: List[str]) -> bytes:
+    """Builds a chunk frame around the encoded text, without building and encoding a dict."""
+    return _CHUNK_PREFIX + dumps_bytes("".join(parts)) + _CHUNK_SUFFIX
+
+
+def _encode_batch(messages: List[Message]) -> List[bytes]:
+    """Encodes queued messages into frames, joining each run of adjacent "chunk" messages into one."""
+    frames: List[bytes] = []
+    chunk_run: List[str] = []
+    for message in messages:
+        if not isinstance(message, bytes) and message.get("type") == "chunk":
+            chunk_run.append(message["content"])
+            continue
+        if chunk_run:
+            frames.append(_chunk_frame(chunk_run))
+            chunk_run = []
+        frames.append(message if isinstance(message, bytes) else dumps_bytes(message))
+    if chunk_run:
+        frames.append(_chunk_frame(chunk_run))
+    return frames
+
+
+def _batch_frames(frames: List[bytes]) -> List[bytes]:
+    """Packs consecutive frames into {"type": "batch", "frames": [...]} frames of up to ~16KB each."""
+    batches: List[bytes] = []
+    group: List[bytes] = []
+    group_size = 0
+    for frame in frames:
+        group.append(frame)
+        group_size += len(frame)
+        if group_size >= _BATCH_MAX_BYTES:
+            batches.append(group[0] if len(group) == 1 else _BATCH_PREFIX + b",".join(group) + _BATCH_SUFFIX)
+            group = []
+            group_size = 0
+    if group:
+        batches.append(group[0] if len(group) == 1 else _BATCH_PREFIX + b",".join(group) + _BATCH_SUFFIX)
+    return batches
+
+
+class Outbox:
+    """Queues messages for one WebSocket without awaiting the send; a writer task sends them in order.
+
+    Everything that piles up while the previous frame is being written goes out together: adjacent
+    chunks are merged and the resulting messages share one batch frame, so a fast token stream
+    costs a few frames instead of one per token. The queue is a deque plus a
+    future the writer sleeps on, which is cheaper than an asyncio.Queue for a single consumer.
+    """
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self._pending: Deque[Message] = deque()
+        self._wakeup: Optional[asyncio.Future] = None
+        self._idle = asyncio.Event() # Set while nothing is queued or being written
+        self._idle.set()
+        self._error: Optional[BaseException] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def put_nowait(self, message: Message) -> None:
+        """Queues a message; raises the writer's send error if the connection has already failed."""
+        if self._error is not None:
+            raise self._error
+        self._pending.append(message)
+        self._idle.clear()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run()) # Started on first use
+        elif self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    async def flush(self) -> None:
+        """Waits until everything queued so far has been sent, so a direct send can't overtake it."""
+        await self._idle.wait()
+        if self._error is not None:
+            raise self._error
+
+    async def close(self) -> None:
+        """Stops the writer; anything still queued is dropped (call once the connection is gone)."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+        self._pending.clear()
+        self._idle.set()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._pending:
+                self._idle.set()
+                self._wakeup = loop.create_future()
+                await self._wakeup
+                self._wakeup = None
+                continue
+            batch = list(self._pending)
+            self._pending.clear()
+            try:
+                for frame in _batch_frames(_encode_batch(batch)):
+                    await self.websocket.send_bytes(frame)
+            except Exception as e:
+                # The connection is gone: remember why, drop the rest and release anyone flushing
+                self._error = e
+                self._pending.clear()
+                self._idle.set()
+                return
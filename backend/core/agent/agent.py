@@ -1,33 +1,334 @@
-import json
-import uuid
 import asyncio
-from typing import Optional, List, Dict, Any, AsyncGenerator, Tuple, TypedDict, Callable
-# Import Stream type for better hinting if needed (optional)
-from openai.types.chat import ChatCompletionChunk
-# ChoiceDeltaToolCall is used for type hinting the chunk, not for accumulation state
-from openai.types.chat.chat_completion_chunk import ChoiceDelta 
-from pydantic import BaseModel
+import copy
+import hashlib
+import logging
+import functools
+import itertools
+import operator
+import re
+from array import array
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Optional, List, Dict, Any, AsyncGenerator, AsyncIterator, Iterable, Set, Tuple, TypedDict, Required, Callable, Final, Mapping
 from dotenv import load_dotenv
-import os
+import tiktoken
 
 # Update import path for llm_client
-from services.llm import get_llm_response_stream
+from services.llm import get_llm_response_stream, StreamDelta, classify_model
+from app.config import get_settings
+from core.tools.base import TOOL_SCHEMAS
+from core.agent.response_cache import response_cache_key, get_cached_response, store_cached_response, replay_cached_response, is_cacheable
+from utils.json_utils import LazyJSON, dumps, dumps_bytes, loads
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+_TOOL_CALL_IDS = itertools.count() # IDs for tool calls the model wrote as bare JSON content
+_STREAM_FLUSH_MAX_CHUNKS = 8 # Flush buffered text after this many deltas even inside the flush window
+
 # Define message structure directly here if not using external types
-# (Matching OpenAI API structure)
+# (Matching OpenAI API structure). Messages stay plain dicts: LiteLLM, the WebSocket handler and the
+# DB layer all consume them as dicts, and orjson serializes them at C speed already
 class MessageDict(TypedDict, total=False):
-    role: str
+    role: Required[str]
     content: str | List[Dict[str, Any]] | None # Content can be None for tool calls
     tool_calls: List[Dict]
     tool_call_id: str
 
-# Structure for yielding a tool call request - REMOVED
-# class ToolCallRequest(TypedDict):
-#     type: str # Should be 'tool_call_request'
-#     tool_calls: List[Dict] # List of requested tool calls
+# --- Step Output Kinds ---
+# step() yields (kind, payload) pairs, so consumers dispatch on a small int instead of isinstance checks
+STEP_TEXT: Final = 0 # payload: text to show the user
+STEP_TOOL_CALLS: Final = 1 # payload: the tool_call_request dict
+STEP_TOOL_PARTIAL: Final = 2 # payload: a tool_call_partial dict (early notice of a complete call)
+STEP_ERROR: Final = 3 # payload: an error dict with "content"
+STEP_COST: Final = 4 # payload: the LLM call's cost, yielded last
+
+# Accumulated calls always carry these keys, so one C-level lookup replaces three .get() calls
+_TOOL_CALL_FIELDS = operator.itemgetter("id", "type", "function")
+
+def _is_valid_tool_call(call: Dict[str, Any]) -> bool:
+    """Checks that an accumulated tool call has an id, the function type and a named function."""
+    call_id, call_type, function = _TOOL_CALL_FIELDS(call)
+    return bool(call_id) and call_type == "function" and isinstance(function, dict) and bool(function.get("name"))
+
+# --- Token Estimation ---
+_MESSAGE_TOKEN_OVERHEAD = 4 # Role/separator tokens added per message by chat formats
+_IMAGE_TOKEN_ESTIMATE = 765 # Approximate cost of one high-detail image part
+
+@functools.lru_cache(maxsize=32)
+def _get_encoding(model_name: Optional[str]) -> "tiktoken.Encoding":
+    """Returns the tokenizer for a model, falling back to cl100k_base for non-OpenAI models."""
+    try:
+        return tiktoken.encoding_for_model((model_name or "").split("/")[-1])
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+def _count_tokens(message: MessageDict, model_name: Optional[str]) -> int:
+    """Estimates the prompt tokens a single memory message costs."""
+    encoding = _get_encoding(model_name)
+    texts: List[str] = []
+    tokens = _MESSAGE_TOKEN_OVERHEAD
+    content = message.get("content")
+    if isinstance(content, str):
+        texts.append(content)
+    elif isinstance(content, list):
+        for part in content:
+            if part.get("type") == "text":
+                texts.append(part.get("text", ""))
+            else:
+                tokens += _IMAGE_TOKEN_ESTIMATE
+    for tool_call in message.get("tool_calls") or []:
+        function = tool_call.get("function", {})
+        texts.append(function.get("name", ""))
+        texts.append(function.get("arguments", ""))
+    for text in texts:
+        tokens += len(encoding.encode(text, disallowed_special=()))
+    return tokens
+# --- End Token Estimation ---
+
+def _truncate_middle(text: str, max_chars: int) -> str:
+    """Keeps the head and tail of text (where commands print their summary and errors)."""
+    half = max_chars // 2
+    return f"{text[:half]}\n[... {len(text) - 2 * half} characters truncated ...]\n{text[-half:]}"
+
+@dataclass(slots=True)
+class _InProgressCall:
+    """Accumulator for one streamed tool call."""
+    id: Optional[str]
+    name: str = ""
+    arg_parts: List[str] = field(default_factory=list) # Argument fragments, joined once after the stream ends
+    announced: bool = False # Whether a tool_call_partial was already yielded
+    parsed_arguments: Optional[Dict[str, Any]] = None # Arguments as parsed for the announcement
+    parsed_part_count: int = 0 # Fragments they covered; later fragments make them stale
+
+# --- Stream Prefetching ---
+_PREFETCH_DONE = object() # End-of-stream sentinel
+_PREFETCH_IDLE = object() # Yielded when nothing arrived within idle_timeout
+
+class _PrefetchError:
+    """Carries an exception raised by the source iterator across the prefetch queue."""
+    __slots__ = ("error",)
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+async def _prefetch(source: AsyncIterator[Any], n: int = 2, idle_timeout: Optional[float] = None) -> AsyncGenerator[Any, None]:
+    """Drains source into a bounded queue from a background task, so the next chunk is read
+    off the network while the current one is processed and shipped by the consumer.
+    With idle_timeout, _PREFETCH_IDLE is yielded whenever the source stays quiet that long.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=n)
+
+    async def produce():
+        try:
+            async for item in source:
+                await queue.put(item)
+        except Exception as e:
+            await queue.put(_PrefetchError(e))
+            return
+        await queue.put(_PREFETCH_DONE)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            if idle_timeout is None or not queue.empty():
+                item = await queue.get()
+            else:
+                try:
+                    item = await asyncio.wait_for(queue.get(), idle_timeout)
+                except asyncio.TimeoutError:
+                    yield _PREFETCH_IDLE
+                    continue
+            if item is _PREFETCH_DONE:
+                break
+            if isinstance(item, _PrefetchError):
+                raise item.error
+            yield item
+    finally:
+        producer.cancel()
+        while not producer.done():
+            # The source may yield once more while unwinding; keep the queue drained so put() can't block
+            while not queue.empty():
+                queue.get_nowait()
+            await asyncio.sleep(0)
+# --- End Stream Prefetching ---
+
+# --- Incremental Tool Call Detection ---
+_JSON_STRUCTURAL = re.compile(r'[\\"{}]')
+_NON_WHITESPACE = re.compile(r"\S")
+
+class _IncrementalToolCallDetector:
+    """Decides in one pass over the streamed deltas whether a response is plain text or a bare JSON tool call.
+
+    Models without native tool calling (e.g. via Ollama) answer with a JSON object instead. The first
+    non-whitespace character commits the response to TEXT (streamed as-is) or JSON (buffered, with brace
+    depth tracked per character so the end of the object is known without re-parsing prefixes).
+    """
+
+    UNKNOWN, TEXT, JSON = range(3)
+    __slots__ = ("state", "_parts", "_depth", "_in_string", "_escape", "_complete", "_trailing")
+
+    def __init__(self):
+        self.state = self.UNKNOWN
+        self._parts: List[str] = [] # Text held back while undecided or JSON
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._complete = False # Top-level object closed
+        self._trailing = False # Non-whitespace after the object, so it can't be a bare tool call
+
+    def feed(self, text: str) -> str:
+        """Consumes a delta and returns the text that can be streamed to the client now."""
+        if self.state == self.TEXT:
+            return text
+        self._parts.append(text)
+        if self.state == self.UNKNOWN:
+            first = _NON_WHITESPACE.search(text) # O(1) reject for prose, no strip() copy
+            if first is None:
+                return ""
+            if text[first.start()] != "{":
+                self.state = self.TEXT
+                return self.take_buffered()
+            self.state = self.JSON
+            self._scan(text, first.start())
+            return ""
+        self._scan(text, 0)
+        return ""
+
+    def _scan(self, text: str, pos: int) -> None:
+        # Jumps between structural characters with a C-level regex search instead of a per-character loop
+        if self._escape: # A backslash ended the previous delta, so this delta's first character is escaped
+            self._escape = False
+            pos += 1
+        if self._complete:
+            if _NON_WHITESPACE.search(text, pos):
+                self._trailing = True
+            return
+        skip_to = pos
+        for match in _JSON_STRUCTURAL.finditer(text, pos):
+            index = match.start()
+            if index < skip_to:
+                continue # Character escaped by the preceding backslash
+            char = text[index]
+            if self._in_string:
+                if char == "\\":
+                    if index + 1 == len(text):
+                        self._escape = True
+                        return
+                    skip_to = index + 2
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._complete = True
+                    if _NON_WHITESPACE.search(text, index + 1):
+                        self._trailing = True
+                    return
+
+    def take_buffered(self) -> str:
+        """Returns and clears the text held back so far."""
+        buffered = "".join(self._parts)
+        self._parts.clear()
+        return buffered
+
+    def finalize(self) -> Optional[Dict[str, Any]]:
+        """Returns the parsed object if the whole response was exactly one JSON object, else None."""
+        if self.state != self.JSON or not self._complete or self._trailing:
+            return None
+        try:
+            parsed = loads("".join(self._parts))
+        except ValueError:
+            return None
+        return parsed if isinstance(parsed, dict) else None
+# --- End Incremental Tool Call Detection ---
+
+# --- System Prompt ---
+# Module-level so every agent sends byte-identical prefix tokens (required for provider prefix caching)
+_SYSTEM_PROMPT: Final[str] = (
+    "You are a helpful assistant that can interact with the user's local machine and maintain a memory of important information. "
+    "You have the following tools available:\n\n"
+    "Memory Tools:\n"
+    "- add_to_memory: Store atomic facts about the user or context. ALWAYS break down complex information into simple, atomic facts before storing. "
+    "Each fact should be a single, clear statement that captures one piece of information. For example, instead of storing "
+    "'User prefers dark mode and uses vim keybindings', store as two facts: ['User prefers dark mode', 'User uses vim keybindings']. "
+    "The system will automatically check for and update similar existing memories.\n"
+    "- fetch_from_memory: Query your memory to recall relevant information. Use this before making assumptions about user preferences or context.\n\n"
+    "System Tools:\n"
+    "- run_bash_command: Execute a bash command on the user's machine. Use this for file operations, running scripts, etc. You do NOT need to ask for permission first.\n"
+    "- read_file: Read the content of any file on the user's machine.\n"
+    "- edit_file: Replace the first occurrence of 'string_to_replace' with 'new_string' in any file on the user's machine. Use with caution.\n"
+    "- paste_at_cursor: Pastes the provided text content at the current cursor location in the user's active application.\n\n"
+    "Web Tools:\n"
+    "- Use `perform_web_search` to either:\n"
+    "  1. Search the web with a query (e.g., \"latest Python features\")\n"
+    "  2. Fetch content from a specific URL (e.g., \"https://docs.python.org\")\n"
+    "- When fetching from a URL, ensure it's accessible and relevant\n"
+    "- For general searches, use specific and focused queries\n"
+    "- Process and summarize the results before presenting to the user\n"
+    "Interaction Tools:\n"
+    "- ask_user: Ask the user a clarifying question if you are unsure how to proceed or need more information. ONLY use this after checking memory first!\n"
+    "- terminate: End the current interaction or task when the goal is achieved, you are stuck, or the user asks to stop.\n\n"
+    "Memory Management Guidelines:\n"
+    "1. ALWAYS check memory BEFORE asking the user for information:\n"
+    "   - Use fetch_from_memory with relevant queries first\n"
+    "   - Try multiple related queries if needed (e.g., 'user location', 'user city', 'where user lives')\n"
+    "   - Only ask the user if no relevant information is found in memory\n"
+    "   Example flow:\n"
+    "   - User asks: 'Find pizza places near me'\n"
+    "   - First action: fetch_from_memory with query 'user location' or 'user city'\n"
+    "   - Only ask location if nothing found in memory\n\n"
+    "2. ALWAYS break down information into atomic facts when using add_to_memory:\n"
+    "   - Each fact should contain ONE piece of information\n"
+    "   - Facts should be clear and unambiguous\n"
+    "   - Use simple, declarative sentences\n"
+    "   Examples:\n"
+    "   - Good: ['User lives in San Francisco', 'User prefers vegetarian food', 'User works in SOMA district']\n"
+    "   - Bad: ['User lives in San Francisco and likes vegetarian food']\n\n"
+    "3. ALWAYS use add_to_memory when you learn new information about:\n"
+    "   - User location and preferences\n"
+    "   - Personal details (city, neighborhood, dietary preferences)\n"
+    "   - Project context (goals, requirements)\n"
+    "   - Technical environment (languages, frameworks)\n"
+    "   - Important decisions made\n"
+    "   - Recurring patterns in behavior\n\n"
+    "4. ALWAYS use fetch_from_memory when:\n"
+    "   - Starting a new interaction\n"
+    "   - Asked about user preferences\n"
+    "   - Making recommendations\n"
+    "   - Needing context about ongoing work\n"
+    "   - Before asking the user for any information\n\n"
+    "Interaction Flow:\n"
+    "1. ALWAYS start by fetching relevant memories about the context:\n"
+    "   - Try multiple related queries to find information\n"
+    "   - Consider different ways to phrase the query\n"
+    "2. Process the user's request using available information\n"
+    "3. Only ask the user for information if nothing relevant found in memory\n"
+    "4. Break down any new information into atomic facts and store them\n"
+    "5. Use terminate when the task is complete\n"
+    "6. Keep responses concise unless asked for more detail\n\n"
+    "Remember: Your memory is persistent! Always check it before asking users to repeat information they've shared before."
+)
+
+# Hash of everything that forms the static request prefix (system prompt + tool schemas)
+_PROMPT_CACHE_KEY = hashlib.sha256(
+    _SYSTEM_PROMPT.encode() + dumps_bytes(TOOL_SCHEMAS, sort_keys=True)
+).hexdigest()[:32]
+
+# Read-only template; each agent gets its own shallow copy so the shared message can't be mutated
+_SYSTEM_MESSAGE: Mapping[str, str] = MappingProxyType({"role": "system", "content": _SYSTEM_PROMPT})
+
+@functools.lru_cache(maxsize=32)
+def _system_prompt_tokens(model_name: Optional[str]) -> int:
+    """Token count of the system message, computed once per model instead of per agent."""
+    return _count_tokens(_SYSTEM_MESSAGE, model_name)
+# --- End System Prompt ---
 
 class ChatAgent:
     """A self-contained agent to manage chat history and interact with an LLM."""
@@ -35,78 +336,27 @@ class ChatAgent:
     # Update type hint for client
     def __init__(self, model_name: str = "gpt-4.1-mini"):
         self.model_name = model_name
-        self.memory: List[MessageDict] = [] # Initialize memory as a list of dictionaries
+        self._provider = classify_model(model_name) if model_name else None # Cached provider dispatch for this model
+        self.memory: List[MessageDict] = [dict(_SYSTEM_MESSAGE)] # Initialize memory as a list of dictionaries
         self.pending_ask_user_tool_call_id: Optional[str] = None # State for pending ask_user ID
-        # --- Updated System Prompt ---
-        system_prompt = (
-            "You are a helpful assistant that can interact with the user's local machine and maintain a memory of important information. "
-            "You have the following tools available:\n\n"
-            "Memory Tools:\n"
-            "- add_to_memory: Store atomic facts about the user or context. ALWAYS break down complex information into simple, atomic facts before storing. "
-            "Each fact should be a single, clear statement that captures one piece of information. For example, instead of storing "
-            "'User prefers dark mode and uses vim keybindings', store as two facts: ['User prefers dark mode', 'User uses vim keybindings']. "
-            "The system will automatically check for and update similar existing memories.\n"
-            "- fetch_from_memory: Query your memory to recall relevant information. Use this before making assumptions about user preferences or context.\n\n"
-            "System Tools:\n"
-            "- run_bash_command: Execute a bash command on the user's machine. Use this for file operations, running scripts, etc. You do NOT need to ask for permission first.\n"
-            "- read_file: Read the content of any file on the user's machine.\n"
-            "- edit_file: Replace the first occurrence of 'string_to_replace' with 'new_string' in any file on the user's machine. Use with caution.\n"
-            "- paste_at_cursor: Pastes the provided text content at the current cursor location in the user's active application.\n\n"
-            "Web Tools:\n"
-            "- Use `perform_web_search` to either:\n"
-            "  1. Search the web with a query (e.g., \"latest Python features\")\n"
-            "  2. Fetch content from a specific URL (e.g., \"https://docs.python.org\")\n"
-            "- When fetching from a URL, ensure it's accessible and relevant\n"
-            "- For general searches, use specific and focused queries\n"
-            "- Process and summarize the results before presenting to the user\n"
-            "Interaction Tools:\n"
-            "- ask_user: Ask the user a clarifying question if you are unsure how to proceed or need more information. ONLY use this after checking memory first!\n"
-            "- terminate: End the current interaction or task when the goal is achieved, you are stuck, or the user asks to stop.\n\n"
-            "Memory Management Guidelines:\n"
-            "1. ALWAYS check memory BEFORE asking the user for information:\n"
-            "   - Use fetch_from_memory with relevant queries first\n"
-            "   - Try multiple related queries if needed (e.g., 'user location', 'user city', 'where user lives')\n"
-            "   - Only ask the user if no relevant information is found in memory\n"
-            "   Example flow:\n"
-            "   - User asks: 'Find pizza places near me'\n"
-            "   - First action: fetch_from_memory with query 'user location' or 'user city'\n"
-            "   - Only ask location if nothing found in memory\n\n"
-            "2. ALWAYS break down information into atomic facts when using add_to_memory:\n"
-            "   - Each fact should contain ONE piece of information\n"
-            "   - Facts should be clear and unambiguous\n"
-            "   - Use simple, declarative sentences\n"
-            "   Examples:\n"
-            "   - Good: ['User lives in San Francisco', 'User prefers vegetarian food', 'User works in SOMA district']\n"
-            "   - Bad: ['User lives in San Francisco and likes vegetarian food']\n\n"
-            "3. ALWAYS use add_to_memory when you learn new information about:\n"
-            "   - User location and preferences\n"
-            "   - Personal details (city, neighborhood, dietary preferences)\n"
-            "   - Project context (goals, requirements)\n"
-            "   - Technical environment (languages, frameworks)\n"
-            "   - Important decisions made\n"
-            "   - Recurring patterns in behavior\n\n"
-            "4. ALWAYS use fetch_from_memory when:\n"
-            "   - Starting a new interaction\n"
-            "   - Asked about user preferences\n"
-            "   - Making recommendations\n"
-            "   - Needing context about ongoing work\n"
-            "   - Before asking the user for any information\n\n"
-            "Interaction Flow:\n"
-            "1. ALWAYS start by fetching relevant memories about the context:\n"
-            "   - Try multiple related queries to find information\n"
-            "   - Consider different ways to phrase the query\n"
-            "2. Process the user's request using available information\n"
-            "3. Only ask the user for information if nothing relevant found in memory\n"
-            "4. Break down any new information into atomic facts and store them\n"
-            "5. Use terminate when the task is complete\n"
-            "6. Keep responses concise unless asked for more detail\n\n"
-            "Remember: Your memory is persistent! Always check it before asking users to repeat information they've shared before."
-        )
-        self.memory.append({"role": "system", "content": system_prompt})
-        # --- End Updated System Prompt ---
+        self._prefix_key = _PROMPT_CACHE_KEY # Stable key for provider-side prompt prefix caching
+        settings = get_settings()
+        self.max_memory_tokens: int = settings.max_memory_tokens # Token budget for memory sent to the LLM
+        self.max_recent_messages: int = settings.recent_messages_kept_verbatim # Newest messages always sent untouched
+        self.recent_turns_kept: int = max(1, settings.recent_turns_kept) # User turns eviction never touches
+        self.old_tool_output_max_chars: int = settings.old_tool_output_max_chars # Head + tail sent for old tool outputs
+        self.stream_flush_ms: float = settings.stream_flush_ms # Coalesce streamed text into flushes of this interval (0 = per delta)
+        # Per-message columns kept parallel to self.memory, so eviction scans don't walk message dicts
+        self._memory_roles: List[str] = ["system"]
+        self._memory_tokens = array("i", [_system_prompt_tokens(model_name)]) # Cached token count per message
+        self._memory_token_total: int = self._memory_tokens[0] # Running sum of _memory_tokens
+        self._memory_sent_tokens = array("i", self._memory_tokens) # What each message costs once old (tool outputs get truncated)
+        self._tool_response_ids: Set[str] = set() # tool_call_ids that already have a tool message
+        self._last_tool_call_message: Optional[MessageDict] = None # Newest assistant message with tool_calls
 
     def set_model(self, model_name: str):
         self.model_name = model_name
+        self._provider = classify_model(model_name) if model_name else None
 
     def add_message_to_memory(self, role: str, content: Optional[str | List[Dict[str, Any]]] = None, tool_calls: Optional[List[Dict]] = None, tool_call_id: Optional[str] = None):
         """Adds a message dictionary to the agent's memory. Also handles adding tool results.
@@ -117,250 +367,429 @@ class ChatAgent:
             message["content"] = content
         if tool_calls is not None:
             message["tool_calls"] = tool_calls
+            if tool_calls:
+                self._last_tool_call_message = message
         if tool_call_id is not None:
             # This assumes role == 'tool' if tool_call_id is provided
             message["tool_call_id"] = tool_call_id
+            self._tool_response_ids.add(tool_call_id)
             if content is None:
                  # Ensure content is at least an empty string for tool results if not provided
                  message["content"] = "" 
                  
-        print(f"[Memory Add] Adding: {message}") # Verbose log
+        logger.debug("[Memory Add] Adding: %s", LazyJSON(message)) # Verbose log, only serialized when DEBUG is enabled
         self.memory.append(message)
+        self._memory_roles.append(role)
+        message_tokens = _count_tokens(message, self.model_name) # Tokenized once here, never re-encoded per step
+        self._memory_tokens.append(message_tokens)
+        self._memory_sent_tokens.append(self._truncated_tokens(message, message_tokens))
+        self._memory_token_total += message_tokens
+        self._evict_if_needed()
+
+    def load_memory(self, messages: Iterable[Tuple[str, Any, Optional[str]]]) -> None:
+        """Restores saved (role, content, tool_call_id) history in bulk: each per-message column grows
+        with one extend and eviction runs once at the end, instead of after every message.
+        """
+        loaded: List[MessageDict] = []
+        for role, content, tool_call_id in messages:
+            message: MessageDict = {"role": role, "content": content}
+            if tool_call_id is not None:
+                message["tool_call_id"] = tool_call_id
+                self._tool_response_ids.add(tool_call_id)
+            loaded.append(message)
+        token_counts = [_count_tokens(message, self.model_name) for message in loaded]
+        self.memory.extend(loaded)
+        self._memory_roles.extend(message["role"] for message in loaded)
+        self._memory_tokens.extend(token_counts)
+        self._memory_sent_tokens.extend(self._truncated_tokens(message, tokens) for message, tokens in zip(loaded, token_counts))
+        self._memory_token_total += sum(token_counts)
+        self._evict_if_needed()
+
+    def has_tool_response(self, tool_call_id: str) -> bool:
+        """Whether a tool message for this call was already added (O(1), no memory scan)."""
+        return tool_call_id in self._tool_response_ids
+
+    def last_tool_calls(self) -> List[Dict[str, Any]]:
+        """The tool calls of the most recent assistant message that made any (O(1), no memory scan)."""
+        message = self._last_tool_call_message
+        return message["tool_calls"] if message is not None else []
+
+    def add_tool_results_to_memory(self, results: Dict[str, str], tool_calls: List[Dict[str, Any]]) -> List[Tuple[str, str]]:
+        """Adds tool results (keyed by tool_call_id) in the order the calls were requested, so
+        memory stays deterministic when the tools finished in a different order.
+        Results for IDs not in tool_calls are appended afterwards. Returns the (id, content) pairs added.
+        """
+        ordered = [(call["id"], results[call["id"]]) for call in tool_calls if call["id"] in results]
+        if len(ordered) < len(results):
+            requested_ids = {call["id"] for call in tool_calls}
+            ordered.extend((tool_call_id, content) for tool_call_id, content in results.items() if tool_call_id not in requested_ids)
+        for tool_call_id, content in ordered:
+            self.add_message_to_memory(role="tool", tool_call_id=tool_call_id, content=content)
+        return ordered
+
+    def _prepare_memory_for_call(self) -> List[MessageDict]:
+        """Returns the messages to send to the LLM: a snapshot of memory with tool outputs older than
+        the recent window cut down to their head and tail. Tool results are usually the largest
+        messages and matter little once the conversation has moved on. The snapshot is a fresh list
+        (message dicts are shared, not copied), so appends to memory during the call can't race the
+        client's background token counting.
+        """
+        boundary = self._truncation_boundary(len(self.memory))
+        if boundary <= 1:
+            return list(self.memory)
+        max_chars = self.old_tool_output_max_chars
+        prepared = list(self.memory)
+        roles = self._memory_roles
+        for index in range(1, boundary):
+            if roles[index] != "tool":
+                continue
+            content = self.memory[index].get("content")
+            if isinstance(content, str) and len(content) > max_chars:
+                prepared[index] = {**self.memory[index], "content": _truncate_middle(content, max_chars)}
+        return prepared
+
+    def _truncation_boundary(self, message_count: int) -> int:
+        """Index before which tool outputs are sent truncated, for memory of message_count messages.
+        The boundary moves in whole windows, so the truncated prefix stays byte-identical
+        for many steps and provider prefix caching keeps hitting.
+        """
+        window = self.max_recent_messages
+        return (message_count - window) // window * window
+
+    def _truncated_tokens(self, message: MessageDict, message_tokens: int) -> int:
+        """Tokens the message costs once _prepare_memory_for_call truncates it (its full count if it never is)."""
+        content = message.get("content")
+        max_chars = self.old_tool_output_max_chars
+        if message["role"] != "tool" or not isinstance(content, str) or len(content) <= max_chars:
+            return message_tokens
+        return _count_tokens({**message, "content": _truncate_middle(content, max_chars)}, self.model_name)
+
+    def _sent_token_total(self, cut: int) -> int:
+        """Tokens memory costs as sent to the LLM once memory[1:cut] is evicted: tool outputs that
+        would then sit behind the truncation boundary count at their truncated size.
+        """
+        tokens = self._memory_tokens
+        boundary = self._truncation_boundary(len(tokens) - (cut - 1)) + cut - 1 # In current indices
+        if boundary <= cut:
+            return self._memory_token_total - sum(tokens[1:cut])
+        return self._memory_token_total - sum(tokens[1:boundary]) + sum(self._memory_sent_tokens[cut:boundary])
+
+    def _evict_if_needed(self):
+        """Drops the oldest messages until memory fits within max_memory_tokens.
+        The system prompt and the last recent_turns_kept user turns (each user message and everything
+        after it) are always kept, so a large tool result never costs the question that asked for it.
+        An assistant tool-call message is evicted together with its tool results so no orphaned pair
+        is sent to the LLM. Sizes are counted as sent, i.e. with old tool outputs truncated.
+        """
+        if self._memory_token_total <= self.max_memory_tokens:
+            return # Even untruncated, everything fits
+        total_tokens = self._sent_token_total(1)
+        if total_tokens <= self.max_memory_tokens:
+            return
+
+        roles = self._memory_roles
+        message_count = len(roles)
+        # Start of the protected tail: the oldest of the last recent_turns_kept user messages
+        protected_start = message_count - 1
+        turns_found = 0
+        for index in range(message_count - 1, 0, -1):
+            if roles[index] == "user":
+                protected_start = index
+                turns_found += 1
+                if turns_found == self.recent_turns_kept:
+                    break
+        cut = 1 # Index after the system prompt; everything in memory[1:cut] gets evicted
+        while total_tokens > self.max_memory_tokens and cut < protected_start:
+            unit_end = cut + 1
+            if roles[cut] == "assistant" and self.memory[cut].get("tool_calls"):
+                # Keep the tool-call request atomic with the tool results answering it
+                while unit_end < message_count and roles[unit_end] == "tool":
+                    unit_end += 1
+            if unit_end > protected_start:
+                break # The unit reaches into the protected turns
+            cut = unit_end
+            total_tokens = self._sent_token_total(cut) # Recomputed: evicting moves the truncation boundary
+
+        # Tool results whose request was already evicted are orphans, drop them as well
+        while cut < protected_start and roles[cut] == "tool":
+            cut += 1
+
+        if cut > 1:
+            if any(message is self._last_tool_call_message for message in self.memory[1:cut]):
+                self._last_tool_call_message = None
+            del self.memory[1:cut]
+            del self._memory_roles[1:cut]
+            self._memory_token_total -= sum(self._memory_tokens[1:cut])
+            del self._memory_tokens[1:cut]
+            del self._memory_sent_tokens[1:cut]
+            total_tokens = self._sent_token_total(1)
+            logger.info("[Agent] Evicted %d old messages from memory. Remaining tokens (est.): %d", cut - 1, total_tokens)
 
     # Refactored step method - handles one LLM call based on current memory
-    async def step(self, api_keys: Optional[Dict[str, str]] = None, callbacks: Optional[List[Callable]] = None, connection_state: Optional[Dict] = None) -> AsyncGenerator[str | Dict[str, Any] | Tuple[str, float], None]:
-        """Performs one step of interaction: gets LLM response and yields content/tool request."""
-        print("[Agent] Executing agent step...")
+    async def step(self, api_keys: Optional[Dict[str, str]] = None, callbacks: Optional[List[Callable]] = None, connection_state: Optional[Dict] = None) -> AsyncGenerator[Tuple[int, Any], None]:
+        """Performs one step of interaction: gets LLM response and yields (kind, payload) pairs (see STEP_TEXT etc.).
+        A tool_call_request carries execution="parallel": its calls are independent, so the caller may
+        run them concurrently (e.g. asyncio.gather) and record results with add_tool_results_to_memory,
+        which restores the original tool-call order.
+        """
+        logger.info("[Agent] Executing agent step...")
         
         # --- Call the LLM Client Function --- 
-        print("[Agent] Requesting LLM stream...")
-        print(f"[Agent DEBUG] LLM Input Messages (step):\n{json.dumps(self.memory, indent=2)}") # Keep debug log here
+        logger.info("[Agent] Requesting LLM stream...")
+        messages = self._prepare_memory_for_call()
+        if logger.isEnabledFor(logging.DEBUG): # Skip walking the whole history unless someone reads it
+            logger.debug("[Agent DEBUG] LLM Input Messages (step): %s", LazyJSON(messages))
         
-        response_stream = get_llm_response_stream(
-            model_name=self.model_name,
-            messages=self.memory,
-            api_keys=api_keys, # Pass keys
-            connection_state=connection_state # Pass connection state
-        )
+        # --- Check the local response cache before going to the network ---
+        cache_key = response_cache_key(self.model_name, messages) if get_settings().llm_cache_enabled else None
+        cached_response = await get_cached_response(cache_key) if cache_key else None
+        if cached_response is not None:
+            logger.info("[Agent] Response cache hit, replaying cached LLM response.")
+            response_stream = replay_cached_response(cached_response)
+        else:
+            response_stream = get_llm_response_stream(
+                model_name=self.model_name,
+                messages=messages,
+                api_keys=api_keys, # Pass keys
+                connection_state=connection_state, # Pass connection state
+                prompt_cache_key=self._prefix_key,
+                provider=self._provider
+            )
         # --- End LLM Client Call --- 
 
         # Process stream for content or tool calls
-        response_content = ""
-        buffered_content = ""  # Buffer for potential JSON response 
-        is_ollama_model = self.model_name.startswith("ollama/")  # Check if using Ollama
-        looks_like_json = False  # Flag to check if response looks like JSON
+        content_parts: List[str] = [] # Text deltas, joined once after the stream ends
+        detector = _IncrementalToolCallDetector() # Holds back responses that look like a bare JSON tool call
         
-        tool_calls_in_progress: Dict[int, Dict[str, Any]] = {} 
+        tool_calls_in_progress: List[Optional[_InProgressCall]] = [] # Indexed by tool call index (small, dense ints)
         finish_reason = None
         error_yielded = False # Flag to track if an error dict was yielded
         captured_finish_reason = None # Explicitly capture finish_reason within the loop
         extracted_cost = None # Variable to store cost tuple value
 
-        async for chunk_or_error in response_stream:
+        # Micro-batching of streamed text: fewer, larger yields (and WebSocket frames) at the same perceived latency
+        loop = asyncio.get_running_loop()
+        flush_interval = self.stream_flush_ms / 1000
+        pending_text: List[str] = []
+        last_flush = loop.time()
+        stop_event = connection_state["stop_event"] if connection_state else asyncio.Event() # Never set without a connection
+        # Bound methods hoisted out of the per-chunk loop
+        append_content = content_parts.append
+        append_pending = pending_text.append
+        loop_time = loop.time
+        # Per-stream invariants decided once instead of per delta
+        feed_detector = detector.feed # Set to None once the response is known to be text
+        stream_every_delta = flush_interval <= 0 # STREAM_FLUSH_MS=0 disables coalescing entirely
+
+        # Overlap reading the next chunk with handling this one; a quiet stream wakes us to flush held text
+        prefetched_stream = _prefetch(response_stream, 2, idle_timeout=None if stream_every_delta else flush_interval)
+        async for chunk_or_error in prefetched_stream:
             # Check for stop signal
-            if connection_state and connection_state.get("stop_requested"):
-                print("[Agent] Stop requested during stream processing")
+            if stop_event.is_set():
+                logger.info("[Agent] Stop requested during stream processing")
                 break
 
+            if chunk_or_error is _PREFETCH_IDLE:
+                # The model paused: send what we hold now instead of waiting for its next delta
+                if pending_text:
+                    yield STEP_TEXT, "".join(pending_text)
+                    pending_text.clear()
+                    last_flush = loop_time()
+                continue
+
             # --- Check for final_cost tuple FIRST --- 
             if isinstance(chunk_or_error, tuple) and chunk_or_error[0] == "final_cost":
                 extracted_cost = chunk_or_error[1] # Store the cost value
-                print(f"[Agent DEBUG] Received final_cost tuple from llm_client: {extracted_cost}")
+                logger.debug("[Agent DEBUG] Received final_cost tuple from llm_client: %s", extracted_cost)
                 continue # Consume the tuple, don't process as chunk
             # --- End check ---
 
             # Check if the yielded item is an error dictionary
             if isinstance(chunk_or_error, dict) and chunk_or_error.get("type") == "error":
-                print(f"[Agent] Received error from LLM client: {chunk_or_error['content']}")
-                yield chunk_or_error # Forward the error dict
+                logger.warning("[Agent] Received error from LLM client: %s", chunk_or_error["content"])
+                if pending_text:
+                    yield STEP_TEXT, "".join(pending_text) # Flush text received before the error
+                    pending_text.clear()
+                if detector.state == detector.JSON:
+                    yield STEP_TEXT, detector.take_buffered() # Held back as a possible tool call; show it
+                yield STEP_ERROR, chunk_or_error # Forward the error dict
                 error_yielded = True
                 break # Stop processing the stream on error
             
-            # Assume it's a ChatCompletionChunk if not an error dict
-            chunk: ChatCompletionChunk = chunk_or_error
-            
-            # --- Start Debug Logging --- 
-            # print(f"[Agent DEBUG] Raw Chunk: {chunk.model_dump_json(indent=2)}")
-            # --- End Debug Logging --- 
+            # Otherwise it's a StreamDelta (plain fields, already extracted by the LLM client)
+            chunk: StreamDelta = chunk_or_error
 
-            choice = chunk.choices[0] if chunk.choices else None
-            if not choice: continue 
-
-            finish_reason = choice.finish_reason
+            finish_reason = chunk.finish_reason
             if finish_reason:
                 captured_finish_reason = finish_reason # Capture it when it appears
 
-            delta: ChoiceDelta | None = choice.delta
+            content = chunk.content
+            tc_chunks = chunk.tool_calls
 
-            if delta and delta.content:
-                response_content += delta.content
-                
-                # Check if this looks like JSON when using Ollama
-                if is_ollama_model:
-                    buffered_content += delta.content
-                    
-                    # Check if response starts to look like JSON
-                    if not looks_like_json and buffered_content.strip().startswith("{"):
-                        looks_like_json = True
-                        print("[Agent DEBUG] Response looks like JSON, buffering content")
-                    
-                    # Only stream if we're certain it's not JSON
-                    if not looks_like_json:
-                        yield delta.content
+            if content:
+                append_content(content)
+                if feed_detector is None:
+                    visible_text = content
                 else:
-                    # For non-Ollama models, stream normally
-                    yield delta.content 
-
-            if delta and delta.tool_calls:
-                # --- Debug Logging for Tool Call Chunks ---
-                # print(f"\n--- [Agent DEBUG] Raw Tool Call Chunk START ---\n{chunk.model_dump_json(indent=2)}\n--- [Agent DEBUG] Raw Tool Call Chunk END ---\n")
-                # --- End Debug Logging ---
-
-                for tc_chunk in delta.tool_calls:
-                    index = tc_chunk.index
-                    # Initialize the standard dictionary if it's the first chunk for this index
-                    if index not in tool_calls_in_progress: 
-                        tool_calls_in_progress[index] = {
-                            "id": tc_chunk.id, 
-                            "type": "function", 
-                            "function": {"name": tc_chunk.function.name or "", "arguments": ""}
-                        }
-                        # print(f"[Agent] Started accumulating tool call index {index}: id={tc_chunk.id}, name='{tc_chunk.function.name}'")
+                    visible_text = feed_detector(content) # Empty while the response may still be a JSON tool call
+                if visible_text:
+                    feed_detector = None # Text was released, so the detector has committed to TEXT for good
+                    if stream_every_delta:
+                        yield STEP_TEXT, visible_text
+                    else:
+                        append_pending(visible_text)
+                        now = loop_time()
+                        if now - last_flush >= flush_interval or len(pending_text) >= _STREAM_FLUSH_MAX_CHUNKS:
+                            yield STEP_TEXT, "".join(pending_text)
+                            pending_text.clear()
+                            last_flush = now
+
+            if tc_chunks:
+                for index, call_id, name, arguments in tc_chunks:
+                    if index >= len(tool_calls_in_progress):
+                        tool_calls_in_progress.extend([None] * (index + 1 - len(tool_calls_in_progress)))
+                    tc_state = tool_calls_in_progress[index]
+                    # Initialize the accumulator state if it's the first chunk for this index
+                    if tc_state is None:
+                        tc_state = tool_calls_in_progress[index] = _InProgressCall(call_id)
                     
                     # Append arguments
-                    if tc_chunk.function and tc_chunk.function.arguments:
-                         tool_calls_in_progress[index]["function"]["arguments"] += tc_chunk.function.arguments
-                         
-                    # Update name if it arrives later
-                    if tc_chunk.function and tc_chunk.function.name and not tool_calls_in_progress[index]["function"]["name"]:
-                         tool_calls_in_progress[index]["function"]["name"] = tc_chunk.function.name
-                         # print(f"[Agent] Updated tool call name for index {index} to '{tc_chunk.function.name}'")
+                    if arguments:
+                        tc_state.arg_parts.append(arguments)
+                    # Set name when it arrives (may come after the first chunk)
+                    if name and not tc_state.name:
+                        tc_state.name = name
+                    # Announce the call as soon as its arguments form complete JSON (cheap "}" check first)
+                    if arguments and not tc_state.announced and tc_state.name and arguments.rstrip().endswith("}"):
+                        arguments_so_far = "".join(tc_state.arg_parts)
+                        try:
+                            parsed_arguments = loads(arguments_so_far)
+                        except ValueError:
+                            pass
+                        else:
+                            tc_state.announced = True
+                            if isinstance(parsed_arguments, dict):
+                                tc_state.parsed_arguments = parsed_arguments
+                                tc_state.parsed_part_count = len(tc_state.arg_parts)
+                            yield STEP_TOOL_PARTIAL, {
+                                "type": "tool_call_partial",
+                                "index": index,
+                                "call": {"id": tc_state.id, "type": "function", "function": {"name": tc_state.name, "arguments": arguments_so_far}},
+                            }
+
+        await prefetched_stream.aclose() # Stops the reader task if we left the loop early (stop/error)
+
+        if pending_text:
+            yield STEP_TEXT, "".join(pending_text) # Flush the remaining text before any tool request/end
+            pending_text.clear()
+        response_content = "".join(content_parts)
+
+        # --- Materialize accumulated tool calls into the standard dictionary shape ---
+        accumulated_tool_calls = [
+            {"id": tc_state.id, "type": "function", "function": {"name": tc_state.name, "arguments": "".join(tc_state.arg_parts)}}
+            for tc_state in tool_calls_in_progress if tc_state is not None
+        ]
+        # Arguments already parsed for an announcement, so the handler doesn't parse them again
+        parsed_tool_arguments = {
+            tc_state.id: tc_state.parsed_arguments
+            for tc_state in tool_calls_in_progress
+            if tc_state is not None and tc_state.parsed_arguments is not None and tc_state.parsed_part_count == len(tc_state.arg_parts)
+        }
 
         # --- Debug Log: After Stream --- 
-        print(f"\n[Agent DEBUG] Stream loop finished.")
+        logger.debug("[Agent DEBUG] Stream loop finished.")
         if not error_yielded:
-            print(f"[Agent DEBUG] Final Finish Reason: {finish_reason}")
+            logger.debug("[Agent DEBUG] Final Finish Reason: %s", finish_reason)
         # --- End Debug Log --- 
 
+        # --- Store completed live responses in the local cache ---
+        stopped = stop_event.is_set()
+        if cache_key and cached_response is None and not error_yielded and not stopped and captured_finish_reason in ("stop", "tool_calls") \
+                and detector.state != detector.JSON and is_cacheable(accumulated_tool_calls): # Bare JSON may be a command-class call
+            await store_cached_response(cache_key, (response_content, copy.deepcopy(accumulated_tool_calls), captured_finish_reason))
+        # --- End cache store ---
+
         # Handle finish reason ONLY if no error was yielded during streaming
         if not error_yielded:
-            if captured_finish_reason == "tool_calls" and tool_calls_in_progress:
+            if captured_finish_reason == "tool_calls" and accumulated_tool_calls:
                 # Finalize tool calls from the accumulated dictionaries
-                final_tool_calls = list(tool_calls_in_progress.values()) 
+                final_tool_calls = accumulated_tool_calls
                 # Basic validation
-                valid_tool_calls = [
-                    call for call in final_tool_calls 
-                    if call.get("id") and call.get("type") == "function" and 
-                       isinstance(call.get("function"), dict) and call["function"].get("name")
-                ]
+                valid_tool_calls = [call for call in final_tool_calls if _is_valid_tool_call(call)]
 
                 # --- Debug log before yielding tool request --- 
-                print(f"[Agent DEBUG] Yielding tool call request: {valid_tool_calls}")
+                logger.debug("[Agent DEBUG] Yielding tool call request: %s", valid_tool_calls)
                 # --- End Debug log --- 
 
                 if valid_tool_calls:
-                    print(f"[Agent] Detected tool calls: {[call['function']['name'] for call in valid_tool_calls]}")
+                    logger.info("[Agent] Detected tool calls: %s", [call["function"]["name"] for call in valid_tool_calls])
                     
                     # Ensure arguments are in the expected string format for all tool calls
                     for call in valid_tool_calls:
                         if isinstance(call.get('function', {}).get('arguments'), dict):
                             # Convert dict arguments to JSON string
-                            call['function']['arguments'] = json.dumps(call['function']['arguments'])
+                            call['function']['arguments'] = dumps(call['function']['arguments'])
                     
                     # Add the assistant message *requesting* the tool call(s) to memory
                     self.add_message_to_memory(role="assistant", tool_calls=valid_tool_calls, content=None)
                     # Yield the request object (plain dict) to the WebSocket handler
-                    yield {"type": 'tool_call_request', "tool_calls": valid_tool_calls}
+                    yield STEP_TOOL_CALLS, {"type": 'tool_call_request', "tool_calls": valid_tool_calls, "execution": "parallel", "parsed_arguments": parsed_tool_arguments}
                 else:
-                     print("[Agent] Warning: Tool call finish reason but no valid tool calls accumulated.")
+                     logger.warning("[Agent] Tool call finish reason but no valid tool calls accumulated.")
                      # Add error state to memory? Or just yield error? 
                      self.add_message_to_memory(role="assistant", content="[Agent Error: Inconsistent tool call state]")
-                     yield {"type": "error", "content": "[Agent Error: Inconsistent tool call detected]"}
+                     yield STEP_ERROR, {"type": "error", "content": "[Agent Error: Inconsistent tool call detected]"}
 
             elif captured_finish_reason == "stop":
-                print(f"[Agent] Finished normally (stop reason). Response length: {len(response_content)}")
-                handled_as_tool_call = False # Flag to check if we parsed it as a tool call
-                if response_content:
-                    try:
-                        # Attempt to parse the content as JSON
-                        parsed_content = json.loads(response_content.strip())
-                        # Check if it looks like the expected tool call structure
-                        if isinstance(parsed_content, dict) and \
-                           parsed_content.get("name") and \
-                           isinstance(parsed_content.get("arguments"), dict):
-                            
-                            print("[Agent] Interpreting JSON content from 'stop' reason as a tool call.")
-                            # Generate a plausible tool call ID (consider improving this)
-                            tool_call_id = f"tool_{parsed_content['name']}_{abs(hash(str(parsed_content['arguments']))) % 10000}"
-                            
-                            # Convert the arguments to a string if it's not already
-                            arguments_json = ""
-                            if isinstance(parsed_content.get('arguments'), dict):
-                                # Serialize the arguments back to a JSON string to match expected format
-                                arguments_json = json.dumps(parsed_content['arguments'])
-                            elif isinstance(parsed_content.get('arguments'), str):
-                                arguments_json = parsed_content['arguments']
-                                
-                            # Build the final tool call with arguments as a serialized JSON string
-                            final_tool_calls = [{
-                                "id": tool_call_id,
-                                "type": "function",
-                                "function": {
-                                    "name": parsed_content['name'],
-                                    "arguments": arguments_json
-                                }
-                            }]
-                            
-                            print(f"[Agent DEBUG] Created tool call: {final_tool_calls}")
-                            
-                            # Add to memory as tool call request
-                            self.add_message_to_memory(role="assistant", tool_calls=final_tool_calls, content=None)
-                            # Yield the request object
-                            yield {"type": 'tool_call_request', "tool_calls": final_tool_calls}
-                            handled_as_tool_call = True
-                            
-                    except json.JSONDecodeError:
-                        # Not JSON, treat as regular text
-                        print("[Agent DEBUG] Content is not valid JSON.")
-                        pass # handled_as_tool_call remains False
-                    except (KeyError, TypeError) as e:
-                        # JSON but not the expected structure
-                        print(f"[Agent DEBUG] Content is JSON but not a valid tool call structure: {e}")
-                        pass # handled_as_tool_call remains False
-                
-                # If it wasn't handled as a tool call, add as regular content
-                if not handled_as_tool_call:
-                    # If we buffered content (for Ollama JSON detection) but it wasn't actually a tool call,
-                    # now we need to yield it to the client
-                    if is_ollama_model and looks_like_json and not handled_as_tool_call:
-                        print("[Agent DEBUG] Buffered content wasn't a tool call, yielding it now")
-                        yield buffered_content
-                        
-                if response_content: 
-                    self.add_message_to_memory(role="assistant", content=response_content)
-                else:
+                logger.info("[Agent] Finished normally (stop reason). Response length: %d", len(response_content))
+                # Already parsed by the detector if the whole response was one JSON object
+                match detector.finalize():
+                    case {"name": tool_name, "arguments": dict() as arguments} if tool_name:
+                        logger.info("[Agent] Interpreting JSON content from 'stop' reason as a tool call.")
+                        # Build the final tool call with arguments as a serialized JSON string
+                        final_tool_calls = [{
+                            "id": f"tool_{tool_name}_{next(_TOOL_CALL_IDS):x}", # Process-unique ID, O(1) regardless of argument size
+                            "type": "function",
+                            "function": {
+                                "name": tool_name,
+                                "arguments": dumps(arguments)
+                            }
+                        }]
+                        logger.debug("[Agent DEBUG] Created tool call: %s", final_tool_calls)
+                        # Add to memory as tool call request
+                        self.add_message_to_memory(role="assistant", tool_calls=final_tool_calls, content=None)
+                        yield STEP_TOOL_CALLS, {"type": 'tool_call_request', "tool_calls": final_tool_calls, "execution": "parallel", "parsed_arguments": {final_tool_calls[0]["id"]: arguments}}
+                    case _ if response_content:
+                        # If we held back JSON-looking content but it wasn't actually a tool call,
+                        # now we need to yield it to the client
+                        if detector.state == detector.JSON:
+                            logger.debug("[Agent DEBUG] Buffered content wasn't a tool call, yielding it now")
+                            yield STEP_TEXT, detector.take_buffered()
+                        self.add_message_to_memory(role="assistant", content=response_content)
+                    case _:
                         # LLM finished with stop but no text and no tool calls
-                        print("[Agent] Warning: Stream finished with stop reason but no text content and not parsed as tool call.")
+                        logger.warning("[Agent] Stream finished with stop reason but no text content and not parsed as tool call.")
                         self.add_message_to_memory(role="assistant", content=None)
             else:
                 # Handle other finish reasons (length, content_filter, etc.) or incomplete streams
-                print(f"[Agent] Stream finished with unexpected reason: {captured_finish_reason}")
+                logger.warning("[Agent] Stream finished with unexpected reason: %s", captured_finish_reason)
+                if detector.state == detector.JSON:
+                    yield STEP_TEXT, detector.take_buffered() # Held back as a possible tool call; show it before the error
                 # Add partial response to memory
                 if response_content:
                      self.add_message_to_memory(role="assistant", content=response_content + f" [Incomplete Response: {captured_finish_reason}]")
                 else:
                      self.add_message_to_memory(role="assistant", content=f"[Agent Error: Stream ended unexpectedly. Reason: {captured_finish_reason}]")
                 # Yield an error message/object
-                yield {"type": "error", "content": f"[Agent Error: Stream ended unexpectedly. Reason: {captured_finish_reason}]"}
+                yield STEP_ERROR, {"type": "error", "content": f"[Agent Error: Stream ended unexpectedly. Reason: {captured_finish_reason}]"}
         else:
-             print("[Agent] Skipping final processing due to earlier error.")
+             logger.info("[Agent] Skipping final processing due to earlier error.")
 
         # --- Yield the cost tuple at the very end if extracted --- 
         if extracted_cost is not None:
-            print(f"[Agent DEBUG] Yielding final_cost tuple: {extracted_cost}")
-            yield ("final_cost", extracted_cost)
+            logger.debug("[Agent DEBUG] Yielding final_cost tuple: %s", extracted_cost)
+            yield STEP_COST, extracted_cost
         # --- End yield --- 
 
-        print("[Agent] Step finished.")
+        logger.info("[Agent] Step finished.")
 
-    # Removed continue_step_with_tool_results method
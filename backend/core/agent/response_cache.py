@@ -0,0 +1,115 @@
+"""Two-tier cache of LLM responses keyed on the exact request (model, tool choice, memory).
+
+Tier 1 is an in-process LRU; tier 2 is an optional persistent diskcache store that survives
+restarts, so retried/resumed sessions with identical history skip the network entirely.
+Both tiers are only active when LLM_CACHE=1.
+"""
+
+import asyncio
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any, AsyncGenerator, Tuple
+
+from app.config import get_settings
+from services.llm import TOOL_CHOICE, StreamDelta
+from core.tools.base import INFORMATIONAL_TOOLS
+from utils.json_utils import dumps_bytes
+
+try:
+    import diskcache
+except ImportError:  # diskcache is optional, only the in-process tier is used without it
+    diskcache = None
+
+# (response_content, tool_calls, finish_reason)
+CachedResponse = Tuple[str, List[Dict[str, Any]], Optional[str]]
+
+_RESPONSE_CACHE: "OrderedDict[str, CachedResponse]" = OrderedDict()
+_disk_cache: Optional["diskcache.Cache"] = None # Opened on first use, see _open_disk_cache()
+_disk_cache_lock = threading.Lock()
+_REPLAY_CHUNK_SIZE = 50 # Characters per replayed content chunk
+
+
+def _disk_cache_enabled() -> bool:
+    return get_settings().llm_cache_enabled and diskcache is not None
+
+
+def _open_disk_cache() -> "diskcache.Cache":
+    """Opens the persistent tier on first use (from a worker thread), in a directory only the owner can read."""
+    global _disk_cache
+    with _disk_cache_lock:
+        if _disk_cache is None:
+            cache_dir = get_settings().llm_disk_cache_dir
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+            os.chmod(cache_dir, 0o700) # makedirs leaves an existing directory's mode alone
+            _disk_cache = diskcache.Cache(cache_dir)
+        return _disk_cache
+
+
+def _disk_get(key: str) -> Any:
+    return _open_disk_cache().get(key)
+
+
+def _disk_set(key: str, value: Dict[str, Any]) -> None:
+    _open_disk_cache().set(key, value, expire=get_settings().llm_disk_cache_ttl)
+
+
+def response_cache_key(model_name: str, messages: List[Dict[str, Any]]) -> str:
+    """Builds the cache key for an LLM request from the model, tool choice and canonical memory."""
+    memory_hash = hashlib.blake2b(dumps_bytes(messages, sort_keys=True), digest_size=16).hexdigest()
+    return f"{model_name}|{TOOL_CHOICE}|{memory_hash}"
+
+
+def is_cacheable(tool_calls: List[Dict[str, Any]]) -> bool:
+    """Only text answers and requests for informational tools are admitted; replaying a
+    command-class tool call (bash, edits, paste, ask_user, terminate) could repeat side effects.
+    """
+    return all(call["function"]["name"] in INFORMATIONAL_TOOLS for call in tool_calls)
+
+
+async def get_cached_response(key: str) -> Optional[CachedResponse]:
+    """Looks the key up in the in-process LRU first, then in the persistent disk cache."""
+    cached = _RESPONSE_CACHE.get(key)
+    if cached is not None:
+        _RESPONSE_CACHE.move_to_end(key)
+        return cached
+    if not _disk_cache_enabled():
+        return None
+    stored = await asyncio.to_thread(_disk_get, key) # SQLite-backed, keep it off the event loop
+    if stored is None:
+        return None
+    cached = (stored["content"], stored["tool_calls"], stored["finish_reason"])
+    _store_in_memory(key, cached) # Promote to the fast tier
+    return cached
+
+
+async def store_cached_response(key: str, response: CachedResponse) -> None:
+    """Stores a completed response in both cache tiers."""
+    _store_in_memory(key, response)
+    if _disk_cache_enabled():
+        content, tool_calls, finish_reason = response
+        value = {"content": content, "tool_calls": tool_calls, "finish_reason": finish_reason}
+        await asyncio.to_thread(_disk_set, key, value)
+
+
+def _store_in_memory(key: str, response: CachedResponse) -> None:
+    _RESPONSE_CACHE[key] = response
+    _RESPONSE_CACHE.move_to_end(key)
+    while len(_RESPONSE_CACHE) > get_settings().llm_cache_max_size:
+        _RESPONSE_CACHE.popitem(last=False) # Evict least recently used
+
+
+async def replay_cached_response(cached: CachedResponse) -> AsyncGenerator[StreamDelta | Tuple[str, float], None]:
+    """Replays a cached response as stream deltas so the agent handles it exactly like a live stream."""
+    response_content, tool_calls, finish_reason = cached
+    for start in range(0, len(response_content), _REPLAY_CHUNK_SIZE):
+        yield StreamDelta(content=response_content[start:start + _REPLAY_CHUNK_SIZE])
+        await asyncio.sleep(0) # Let the consumer ship each piece, preserving streaming semantics
+    if tool_calls:
+        yield StreamDelta(tool_calls=[
+            (index, call["id"], call["function"]["name"], call["function"]["arguments"])
+            for index, call in enumerate(tool_calls)
+        ])
+    yield StreamDelta(finish_reason=finish_reason)
+    yield ("final_cost", 0.0) # Cache hits cost nothing
@@ -2,6 +2,9 @@
 
 from .base import (
     SERVER_EXECUTABLE_TOOLS,
+    CLIENT_EXECUTABLE_TOOLS,
+    ToolContext,
+    ServerTool,
     TOOL_SCHEMAS,
     tavily_client,
     llm,
@@ -42,6 +45,9 @@ from .memory_tools import (
 
 __all__ = [
     'SERVER_EXECUTABLE_TOOLS',
+    'CLIENT_EXECUTABLE_TOOLS',
+    'ToolContext',
+    'ServerTool',
     'TOOL_SCHEMAS',
     'tavily_client',
     'llm',
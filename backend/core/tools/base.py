@@ -1,18 +1,12 @@
 """Core functionality and base imports."""
 
 import asyncio
-import os
-from dotenv import load_dotenv
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Tuple
 from tavily import TavilyClient
 from langchain_openai import ChatOpenAI
 
-from app.config import (
-    TAVILY_API_KEY,
-    OPENAI_API_KEY,
-    DEFAULT_MODEL,
-    PLANNER_MODEL,
-    CHROME_PATH
-)
+from app.config import get_settings
 
 # Import tool modules
 from .file_tools import (
@@ -44,31 +38,85 @@ from .memory_tools import (
 )
 
 # --- Load Env Vars and Initialize Clients ---
-load_dotenv()
-tavily_api_key = os.getenv("TAVILY_API_KEY")
+settings = get_settings()
+tavily_api_key = settings.tavily_api_key
 if not tavily_api_key:
     print("[WARN] TAVILY_API_KEY not found in environment variables. Search tool will not work.")
     tavily_client = None
 else:
     tavily_client = TavilyClient(api_key=tavily_api_key)
 
-openai_api_key = os.getenv("OPENAI_API_KEY")
+openai_api_key = settings.openai_api_key
 if not openai_api_key:
     print("[WARN] OPENAI_API_KEY not found in environment variables. Browser tool will not work.")
     llm = None
 else:
     # Initialize the LLM globally for the browser tool
-    llm = ChatOpenAI(model="gpt-4.1-mini", openai_api_key=openai_api_key) 
-    planner_llm = ChatOpenAI(model='o3-mini', openai_api_key=openai_api_key)
+    llm = ChatOpenAI(model=settings.default_model, openai_api_key=openai_api_key) 
+    planner_llm = ChatOpenAI(model=settings.planner_model, openai_api_key=openai_api_key)
 # --- End Init ---
 
 # --- Registry for Server-Executable Tools --- 
-SERVER_EXECUTABLE_TOOLS = {
-    "search": perform_web_search,
-    # "browser_user": execute_browser_task,
-    "add_to_memory": add_to_memory,
-    "fetch_from_memory": fetch_from_memory,
+@dataclass(frozen=True, slots=True)
+class ToolContext:
+    """Per-connection values passed to every server tool alongside the model's arguments."""
+    websocket: Any
+    websocket_id: str
+    pending_questions: Dict[str, Dict[str, asyncio.Future]]
+
+ServerTool = Callable[..., Awaitable[Any]] # Called as tool(ctx, **arguments)
+
+def _without_context(tool: Callable[..., Awaitable[Any]]) -> ServerTool:
+    """Adapts a tool that only needs its own arguments to the (ctx, **arguments) signature."""
+    async def run(ctx: ToolContext, **arguments: Any) -> Any:
+        return await tool(**arguments)
+    return run
+
+# Browser runs in progress, by (websocket_id, task): a repeat of the same task joins the running one
+_BROWSER_TASKS_IN_FLIGHT: Dict[Tuple[str, str], asyncio.Future] = {}
+
+async def _browser_user(ctx: ToolContext, task: str = "") -> str:
+    if not task:
+        return "Error: Missing 'task' argument for browser_user tool."
+    key = (ctx.websocket_id, task)
+    in_flight = _BROWSER_TASKS_IN_FLIGHT.get(key)
+    if in_flight is not None:
+        return await asyncio.shield(in_flight) # Cancelling this caller must not cancel the shared run
+    future = asyncio.get_running_loop().create_future()
+    _BROWSER_TASKS_IN_FLIGHT[key] = future
+    try:
+        result = await execute_browser_task(
+            task=task,
+            websocket=ctx.websocket,
+            websocket_id=ctx.websocket_id,
+            pending_questions_dict=ctx.pending_questions
+        )
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        future.exception() # Marks it retrieved, so there's no warning when nobody joined
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        del _BROWSER_TASKS_IN_FLIGHT[key]
+
+SERVER_EXECUTABLE_TOOLS: Dict[str, ServerTool] = {
+    "search": _without_context(perform_web_search),
+    # "browser_user": _browser_user,
+    "add_to_memory": _without_context(add_to_memory),
+    "fetch_from_memory": _without_context(fetch_from_memory),
 }
+
+# Tools the Electron client runs on the user's machine (sent back to it in a tool_call_request)
+CLIENT_EXECUTABLE_TOOLS = frozenset({"run_bash_command", "read_file", "edit_file", "paste_at_cursor"})
+
+# Read-only tools whose requests may be replayed from the LLM response cache;
+# anything that acts on the machine or the user (bash, edits, paste, ask, terminate) is never cached
+INFORMATIONAL_TOOLS = frozenset({"search", "read_file", "fetch_from_memory"})
 # --- End Registry --- 
 
 # List of tool schemas to pass to the API
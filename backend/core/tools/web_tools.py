@@ -6,6 +6,9 @@ import aiohttp
 from typing import Optional
 from bs4 import BeautifulSoup
 from browser_use import Agent, Browser, BrowserConfig, Controller, ActionResult
+from utils.json_utils import dumps_bytes
+
+MAX_PENDING_QUESTIONS = 100 # Unanswered browser-agent questions allowed per connection
 
 async def fetch_url_content(url: str) -> str:
     """Fetches and processes content from a specific URL.
@@ -130,17 +133,18 @@ async def execute_browser_task(task: str, websocket, websocket_id: str, pending_
 
         @controller.action('Ask user for information or permission to proceed')
         async def ask_human_via_websocket(question: str) -> ActionResult:
+            questions = pending_questions_dict.setdefault(websocket_id, {})
+            if len(questions) >= MAX_PENDING_QUESTIONS: # Bound the dict so a stuck client can't grow it forever
+                print(f"[Server Tool Error - ask_human] Too many unanswered questions for websocket {websocket_id}")
+                return ActionResult(extracted_content="Error: Too many unanswered questions for this user.")
             request_id = str(uuid.uuid4())
             future = asyncio.Future()
-
-            if websocket_id not in pending_questions_dict:
-                pending_questions_dict[websocket_id] = {}
-            pending_questions_dict[websocket_id][request_id] = future
+            questions[request_id] = future
 
             try:
                 message = {'type': 'agent_question', 'request_id': request_id, 'question': question}
                 print(f"[Server Tool - ask_human] Sending question (req_id: {request_id}) to websocket {websocket_id}: {question}")
-                await websocket.send_json(message) 
+                await websocket.send_bytes(dumps_bytes(message))
 
                 answer = await asyncio.wait_for(future, timeout=300.0)
                 print(f"[Server Tool - ask_human] Received answer (req_id: {request_id}) from websocket {websocket_id}: {answer}")
@@ -154,10 +158,9 @@ async def execute_browser_task(task: str, websocket, websocket_id: str, pending_
                     future.set_exception(e)
                 return ActionResult(extracted_content=f"Error: Failed to get user input - {e}")
             finally:
-                if websocket_id in pending_questions_dict and request_id in pending_questions_dict[websocket_id]:
-                    del pending_questions_dict[websocket_id][request_id]
-                    if not pending_questions_dict[websocket_id]:
-                        del pending_questions_dict[websocket_id]
+                questions = pending_questions_dict.get(websocket_id)
+                if questions is not None and questions.pop(request_id, None) is not None and not questions:
+                    del pending_questions_dict[websocket_id]
 
         async def send_step_update_to_client(agent):
             try:
@@ -176,7 +179,7 @@ async def execute_browser_task(task: str, websocket, websocket_id: str, pending_
                 }
                 message = {'type': 'agent_step_update', 'data': update_data}
                 print(f"[Server Tool - hook] Sending step update to websocket {websocket_id}")
-                await websocket.send_json(message)
+                await websocket.send_bytes(dumps_bytes(message))
             except Exception as e:
                 print(f"[Server Tool Error - hook] Failed to send step update to websocket {websocket_id}: {e}")
 
@@ -210,12 +213,12 @@ async def execute_browser_task(task: str, websocket, websocket_id: str, pending_
         if browser:
             print(f"[Server Tool] Closing browser for websocket {websocket_id}")
             await browser.close()
-        if websocket_id in pending_questions_dict:
+        questions = pending_questions_dict.pop(websocket_id, None)
+        if questions:
             print(f"[Server Tool] Cleaning up pending questions for websocket {websocket_id} on exit.")
-            for request_id, future in pending_questions_dict.get(websocket_id, {}).items():
+            for request_id, future in questions.items():
                 if not future.done():
                     future.cancel("Browser agent task terminated unexpectedly.")
-            del pending_questions_dict[websocket_id]
 
 # --- Tool Schemas ---
 SEARCH_TOOL_SCHEMA = {
@@ -1,15 +1,22 @@
 import aiosqlite
+import asyncio
+import base64
+import binascii
 import datetime
-import json
 import traceback
-from typing import Any, Optional
+import uuid
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from app.config import get_settings
+from utils.json_utils import dumps
+from db.pool import connect_db, db_pool
 
 # --- Database Constants ---
-DATABASE_URL = "./nohup.db"
+DATABASE_URL = get_settings().database_url
 
 # --- Database Initialization ---
 async def init_db():
-    async with aiosqlite.connect(DATABASE_URL) as db:
+    async with await connect_db() as db:
         await db.execute("""
             CREATE TABLE IF NOT EXISTS chats (
                 chat_id TEXT PRIMARY KEY,
@@ -31,15 +38,47 @@ async def init_db():
                 FOREIGN KEY (chat_id) REFERENCES chats(chat_id)
             )
         """)
+        # Images are kept out of the message JSON so the messages table stays small
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS attachments (
+                attachment_id TEXT PRIMARY KEY,
+                chat_id TEXT NOT NULL,
+                mime_type TEXT NOT NULL,
+                data BLOB NOT NULL,
+                FOREIGN KEY (chat_id) REFERENCES chats(chat_id)
+            )
+        """)
         await db.commit()
     print("Database initialized.")
 
+# --- Attachments ---
+Attachment = Tuple[str, str, bytes] # (attachment_id, mime_type, data)
+
+def attachment_from_data_url(data_url: str) -> Optional[Attachment]:
+    """Decodes a base64 data: URL into an attachment with a fresh id; None if it isn't one."""
+    header, sep, payload = data_url.partition(",")
+    if not sep or not header.startswith("data:") or not header.endswith(";base64"):
+        return None
+    try:
+        data = base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    return str(uuid.uuid4()), header[5:-7], data
+
+async def load_attachment_urls(db: aiosqlite.Connection, chat_id: str) -> Dict[str, str]:
+    """Returns the chat's attachments as data: URLs keyed by attachment_id."""
+    urls: Dict[str, str] = {}
+    async with db.execute("SELECT attachment_id, mime_type, data FROM attachments WHERE chat_id = ?", (chat_id,)) as cursor:
+        async for attachment_id, mime_type, data in cursor:
+            urls[attachment_id] = f"data:{mime_type};base64,{base64.b64encode(data).decode('ascii')}"
+    return urls
+
 # --- Database Operations ---
 async def save_message_to_db(chat_id: str, role: str, content: Any, tool_call_id: Optional[str] = None):
     """Helper function to save a message to the database."""
-    content_str = json.dumps(content) if not isinstance(content, str) else content
+    content_str = dumps(content) if not isinstance(content, str) else content
     try:
-        async with aiosqlite.connect(DATABASE_URL) as db:
+        async with db_pool.writer() as db:
             await db.execute(
                 "INSERT INTO messages (chat_id, role, content, tool_call_id) VALUES (?, ?, ?, ?)",
                 (chat_id, role, content_str, tool_call_id)
@@ -49,11 +88,39 @@ async def save_message_to_db(chat_id: str, role: str, content: Any, tool_call_id
         print(f"[DB Error] Failed to save message for chat {chat_id}: {e}")
         traceback.print_exc()
 
+async def save_messages_to_db(
+    chat_id: str,
+    messages: Iterable[Tuple[str, Any, Optional[str]]],
+    title: Optional[str] = None,
+    attachments: Iterable[Attachment] = (),
+):
+    """Saves several (role, content, tool_call_id) rows, the chat title and any attachments in a single transaction."""
+    rows = [
+        (chat_id, role, dumps(content) if not isinstance(content, str) else content, tool_call_id)
+        for role, content, tool_call_id in messages
+    ]
+    try:
+        async with db_pool.writer() as db:
+            await db.executemany(
+                "INSERT INTO messages (chat_id, role, content, tool_call_id) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            await db.executemany(
+                "INSERT INTO attachments (attachment_id, chat_id, mime_type, data) VALUES (?, ?, ?, ?)",
+                [(attachment_id, chat_id, mime_type, data) for attachment_id, mime_type, data in attachments]
+            )
+            if title is not None:
+                await db.execute("UPDATE chats SET title = ? WHERE chat_id = ?", (title, chat_id))
+            await db.commit() # One commit (and one fsync) for the whole batch
+    except Exception as e:
+        print(f"[DB Error] Failed to save messages for chat {chat_id}: {e}")
+        traceback.print_exc()
+
 async def update_chat_metadata_in_db(chat_id: str, total_cost: float, current_model: Optional[str] = None):
     """Helper function to update chat metadata (cost, model, last_active) in the database."""
     now = datetime.datetime.now(datetime.timezone.utc)
     try:
-        async with aiosqlite.connect(DATABASE_URL) as db:
+        async with db_pool.writer() as db:
             if current_model is not None:
                  await db.execute(
                      "UPDATE chats SET total_cost = ?, current_model = ?, last_active_at = ? WHERE chat_id = ?",
@@ -76,9 +143,40 @@ async def update_chat_title_in_db(chat_id: str, title: str) -> None:
         chat_id: The ID of the chat to update
         title: The new title for the chat
     """
-    async with aiosqlite.connect(DATABASE_URL) as db:
+    async with db_pool.writer() as db:
         await db.execute(
             "UPDATE chats SET title = ? WHERE chat_id = ?",
             (title, chat_id)
         )
-        await db.commit() 
\ No newline at end of file
+        await db.commit() 
+
+# --- Last Active Tracking ---
+# Handshakes only record the time here; a background task writes all of them in one transaction
+LAST_ACTIVE: Dict[str, datetime.datetime] = {}
+
+def mark_chat_active(chat_id: str, when: datetime.datetime) -> None:
+    """Queues a last_active_at update for the next flush."""
+    LAST_ACTIVE[chat_id] = when
+
+async def flush_last_active() -> None:
+    """Writes every queued last_active_at update with a single commit."""
+    if not LAST_ACTIVE:
+        return
+    pending = list(LAST_ACTIVE.items())
+    LAST_ACTIVE.clear()
+    try:
+        async with db_pool.writer() as db:
+            await db.executemany(
+                "UPDATE chats SET last_active_at = ? WHERE chat_id = ?",
+                [(when, chat_id) for chat_id, when in pending]
+            )
+            await db.commit()
+    except Exception as e:
+        print(f"[DB Error] Failed to update last_active_at for {len(pending)} chat(s): {e}")
+        traceback.print_exc()
+
+async def flush_last_active_periodically(interval: float = 5.0) -> None:
+    """Flushes queued last_active_at updates every interval seconds (run as a task, cancel on shutdown)."""
+    while True:
+        await asyncio.sleep(interval)
+        await flush_last_active()
@@ -0,0 +1,88 @@
+"""Shared SQLite connections: a small pool of readers plus one dedicated writer."""
+
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional
+
+import aiosqlite
+
+from app.config import get_settings
+
+# Applied to every connection: WAL lets the readers run alongside the writer,
+# and the page cache is kept per connection, so connections are held open rather than reopened
+_CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-20000", # ~20MB
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456", # Read pages through a 256MB memory map instead of read() calls
+    "PRAGMA busy_timeout=5000", # Wait up to 5s for a lock instead of failing with SQLITE_BUSY
+)
+
+
+async def connect_db() -> aiosqlite.Connection:
+    """Opens a configured connection to the chat database."""
+    db = await aiosqlite.connect(get_settings().database_url)
+    for pragma in _CONNECTION_PRAGMAS:
+        await db.execute(pragma)
+    db.row_factory = aiosqlite.Row # Access columns by name
+    return db
+
+
+class ConnectionPool:
+    """Readers are handed out from a queue; all writes go through the single writer connection.
+
+    SQLite in WAL mode allows many readers but only one writer, so funnelling every write
+    through one lock-guarded connection avoids SQLITE_BUSY when several chats write at once.
+    The lock is FIFO, so a chat's writes also commit in the order they were issued; callers
+    don't need a per-chat lock of their own.
+    """
+
+    def __init__(self, readers: int):
+        self.size = readers
+        self._readers: "asyncio.Queue[aiosqlite.Connection]" = asyncio.Queue()
+        self._all_readers: List[aiosqlite.Connection] = []
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+
+    async def open(self) -> None:
+        """Opens the writer and the reader connections (call on startup)."""
+        self._writer = await connect_db()
+        for _ in range(self.size):
+            db = await connect_db()
+            self._all_readers.append(db)
+            self._readers.put_nowait(db)
+
+    async def close(self) -> None:
+        """Closes every connection (call on shutdown)."""
+        for db in self._all_readers:
+            await db.close()
+        self._all_readers.clear()
+        self._readers = asyncio.Queue()
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Borrows a reader connection, waiting if all of them are in use."""
+        db = await self._readers.get()
+        try:
+            yield db
+        finally:
+            self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def writer(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Holds the writer connection exclusively; commit before leaving the block."""
+        if self._writer is None:
+            raise RuntimeError("Database pool is not open")
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback() # Don't leave a half-written transaction for the next caller
+                raise
+
+
+db_pool = ConnectionPool(readers=get_settings().db_pool_readers)
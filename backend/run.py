@@ -1,11 +1,17 @@
+import importlib.util
+
 import uvicorn
 from app.main import app
 
+# uvloop (installed with uvicorn[standard]) runs the WebSocket I/O on libuv; fall back to asyncio without it
+EVENT_LOOP = "uvloop" if importlib.util.find_spec("uvloop") is not None else "asyncio"
+
 if __name__ == "__main__":
-    print("Starting FastAPI server...")
+    print(f"Starting FastAPI server ({EVENT_LOOP} event loop)...")
     uvicorn.run(
         "app.main:app",
         host="127.0.0.1",
         port=8000,
+        loop=EVENT_LOOP,
         reload=True  # Enable auto-reload during development
-    ) 
\ No newline at end of file
+    )
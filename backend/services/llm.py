@@ -1,68 +1,211 @@
 import os
 import json
 import asyncio
+import functools
+import logging
+import httpx
 import litellm
-from typing import List, Dict, Any, AsyncGenerator, Union, Optional, Callable, Tuple
-from openai.types.chat import ChatCompletionChunk
+from dataclasses import dataclass
+from typing import List, Dict, Any, AsyncGenerator, Union, Optional, Callable, Tuple, Literal, Sequence
 from dotenv import load_dotenv
 from core.tools.base import TOOL_SCHEMAS
+from app.config import get_settings
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# --- Shared HTTP Client ---
+# One pooled HTTP/2 client for every LLM request, so concurrent agents multiplex over
+# warm connections instead of paying a TCP+TLS handshake per stream
+llm_http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(60.0, connect=5.0),
+    limits=httpx.Limits(max_connections=256, max_keepalive_connections=128),
+)
+litellm.aclient_session = llm_http_client
+
+async def close_llm_http_client() -> None:
+    """Closes the shared LLM HTTP client (call on application shutdown)."""
+    await llm_http_client.aclose()
+# --- End Shared HTTP Client ---
+
+# Caps concurrent LLM streams across all agents; excess callers queue instead of hitting rate limits
+_LLM_SEMAPHORE = asyncio.Semaphore(get_settings().llm_max_concurrency)
+
+# --- Request Batching ---
+class _BatchScheduler:
+    """Collects completion requests arriving within a short window and opens their streams together.
+
+    A self-hosted server with continuous batching (vLLM, sglang) can only fuse prompts it sees
+    at the same time, so concurrent agent steps are released as one burst instead of trickling in.
+    """
+
+    def __init__(self, window_ms: int, max_batch: int):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._dispatches: set = set() # Strong references to in-flight dispatch tasks
+
+    async def submit(self, completion_kwargs: Dict[str, Any]) -> Any:
+        """Queues a request and returns its LiteLLM stream once its batch has been dispatched."""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((completion_kwargs, future))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # Dispatch without awaiting so the next window starts collecting immediately
+            task = asyncio.create_task(self._dispatch(batch))
+            self._dispatches.add(task)
+            task.add_done_callback(self._dispatches.discard)
+
+    @staticmethod
+    async def _dispatch(batch: List[Tuple[Dict[str, Any], asyncio.Future]]) -> None:
+        logger.info("[LLM Client] Dispatching batch of %d request(s)", len(batch))
+        results = await asyncio.gather(
+            *(litellm.acompletion(**completion_kwargs) for completion_kwargs, _ in batch),
+            return_exceptions=True,
+        )
+        for (_, future), result in zip(batch, results):
+            if future.cancelled():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+_BATCH_SCHEDULER = (
+    _BatchScheduler(get_settings().llm_batch_window_ms, get_settings().llm_batch_max_size)
+    if get_settings().llm_batch_window_ms > 0 else None
+)
+# --- End Request Batching ---
+
+# (index, id, name, arguments) for one tool-call fragment; id/name usually only on the first fragment
+ToolCallFragment = Tuple[int, Optional[str], Optional[str], Optional[str]]
+
+@dataclass(slots=True)
+class StreamDelta:
+    """The fields of one streamed chunk that the agent reads, extracted once from the provider's model."""
+    content: Optional[str] = None
+    tool_calls: Optional[List[ToolCallFragment]] = None
+    finish_reason: Optional[str] = None
+
+def _to_stream_delta(choice: Any) -> StreamDelta:
+    delta = choice.delta
+    if delta is None:
+        return StreamDelta(finish_reason=choice.finish_reason)
+    tool_calls = None
+    if delta.tool_calls:
+        tool_calls = []
+        for tc_chunk in delta.tool_calls:
+            function = tc_chunk.function
+            if function is None:
+                tool_calls.append((tc_chunk.index, tc_chunk.id, None, None))
+            else:
+                tool_calls.append((tc_chunk.index, tc_chunk.id, function.name, function.arguments))
+    return StreamDelta(delta.content, tool_calls, choice.finish_reason)
+
+# Tool choice sent with every completion request (also part of the agent's response cache key)
+TOOL_CHOICE = "auto"
+
+# Request arguments that never change between calls, built once at import instead of per step
+_STATIC_COMPLETION_KWARGS: Dict[str, Any] = {
+    "tools": TOOL_SCHEMAS,
+    "tool_choice": TOOL_CHOICE,
+    "stream": True,
+    "stream_options": {"include_usage": True}, # Request usage data in the stream
+}
+
+Provider = Literal["openai", "anthropic", "groq", "ollama", "other"]
+
+@functools.lru_cache(maxsize=64)
+def classify_model(model_name: str) -> Provider:
+    """Maps a model string to its provider (decided once per model, not per request)."""
+    if model_name.startswith("ollama/"):
+        return "ollama"
+    if "gpt-" in model_name or model_name.startswith("openai/"):
+        return "openai"
+    if "claude-" in model_name or model_name.startswith("anthropic/"):
+        return "anthropic"
+    if "groq/" in model_name:
+        return "groq"
+    return "other"
+
 async def get_llm_response_stream(
     model_name: str,
-    messages: List[Dict[str, Any]],
+    messages: Sequence[Dict[str, Any]],  # Read-only snapshot, never mutated here
     temperature: float = 0.7,
     max_tokens: Optional[int] = None,
     api_keys: Optional[Dict[str, str]] = None,
-    connection_state: Optional[Dict] = None  # Add connection_state parameter
-) -> AsyncGenerator[ChatCompletionChunk | Dict[str, str] | Tuple[str, float], None]:
-    """Gets a streaming response from LiteLLM, yielding chunks or error dicts."""
+    connection_state: Optional[Dict] = None,  # Add connection_state parameter
+    prompt_cache_key: Optional[str] = None,  # Stable prefix hash for OpenAI prompt caching
+    provider: Optional[Provider] = None  # Pre-classified provider; derived from model_name if omitted
+) -> AsyncGenerator[StreamDelta | Dict[str, str] | Tuple[str, float], None]:
+    """Gets a streaming response from LiteLLM, yielding StreamDeltas or error dicts."""
     stream_kwargs = {
+        **_STATIC_COMPLETION_KWARGS,
         "model": model_name,
         "messages": messages,
         "temperature": temperature,
-        "stream": True,
-        "stream_options": {"include_usage": True}, # Request usage data in the stream
     }
     if max_tokens:
         stream_kwargs["max_tokens"] = max_tokens
+    if provider is None:
+        provider = classify_model(model_name)
+    if prompt_cache_key and provider == "openai":
+        # Routes requests sharing a prefix to the same cache shard (OpenAI-only parameter)
+        stream_kwargs["extra_body"] = {"prompt_cache_key": prompt_cache_key}
     
     # --- Determine the specific API key to use for this call --- # ADDED
     session_api_key: Optional[str] = None # ADDED
     if api_keys: # ADDED
-        # Basic provider detection from model name
-        if "gpt-" in model_name or model_name.startswith("openai/"): # ADDED
-            session_api_key = api_keys.get("openai") # ADDED
-        elif "claude-" in model_name or model_name.startswith("anthropic/"): # ADDED
-            session_api_key = api_keys.get("anthropic") # ADDED
-        elif "groq/" in model_name: # ADDED
-             session_api_key = api_keys.get("groq") # ADDED
-        # Add more providers as needed... # ADDED
+        if provider in ("openai", "anthropic", "groq"): # Add more providers as needed...
+            session_api_key = api_keys.get(provider)
         
         if session_api_key: # ADDED
-            print(f"[LLM Client] Using session API key for {model_name.split('/')[0] if '/' in model_name else 'provider'}.") # ADDED
+            logger.info("[LLM Client] Using session API key for %s.", model_name.split('/')[0] if '/' in model_name else 'provider') # ADDED
     # --- End API Key Determination --- # ADDED
     
-    print(f"[LLM Client - LiteLLM] Requesting completion from {model_name}...")
+    logger.info("[LLM Client - LiteLLM] Requesting completion from %s...", model_name)
     
     # Determine provider name for error messages BEFORE the try block
     llm_provider_name = model_name.split('/')[0] if '/' in model_name else model_name # MOVED here
     
+    # Held for the whole stream (not just connection setup) so it bounds open streams
+    if _LLM_SEMAPHORE.locked():
+        logger.info("[LLM Client] Concurrency limit (%d) reached, waiting for a free slot...", get_settings().llm_max_concurrency)
+    await _LLM_SEMAPHORE.acquire()
     try:
         api_base = None
-        if model_name.startswith("ollama/"):
+        if provider == "ollama":
             api_base = "http://localhost:11434" 
-            print(f"[LLM Client - LiteLLM] Using Ollama model, setting api_base: {api_base}")
+            logger.info("[LLM Client - LiteLLM] Using Ollama model, setting api_base: %s", api_base)
         # Use litellm.acompletion for asynchronous streaming
-        stream_object = await litellm.acompletion(
-            tools=TOOL_SCHEMAS,
-            tool_choice="auto",
-            api_base=api_base,
-            api_key=session_api_key,
-            **stream_kwargs
-        )
+        if _BATCH_SCHEDULER is not None:
+            stream_object = await _BATCH_SCHEDULER.submit({"api_base": api_base, "api_key": session_api_key, **stream_kwargs})
+        else:
+            stream_object = await litellm.acompletion(
+                api_base=api_base,
+                api_key=session_api_key,
+                **stream_kwargs
+            )
         # Iterate through the stream yielded by LiteLLM
         finish_reason = None
         error_yielded = False # Flag to track if an error dict was yielded
@@ -73,13 +216,15 @@ async def get_llm_response_stream(
 
         # Initialize calculated_cost outside the loop, before finally
         calculated_cost = 0.0 
-        response_content = ""
+        content_parts: List[str] = [] # Streamed text and tool-call argument fragments, joined once for the token count
         # llm_provider_name = model_name.split('/')[0] if '/' in model_name else model_name # REMOVED from here
 
+        debug_chunks = logger.isEnabledFor(logging.DEBUG) # Checked once; dumping every chunk is expensive
+        stop_event = connection_state["stop_event"] if connection_state else asyncio.Event() # Never set without a connection
         async for chunk in stream_object:
             # Check for stop signal
-            if connection_state and connection_state.get("stop_requested"):
-                print("[LLM Client] Stop requested during streaming")
+            if stop_event.is_set():
+                logger.info("[LLM Client] Stop requested during streaming")
                 break
 
             # --- Capture Usage from Chunk --- 
@@ -94,17 +239,32 @@ async def get_llm_response_stream(
             # --- End Usage Capture ---
             
             # --- Start Debug Logging --- 
-            print(f"[LLM Client DEBUG] Raw Chunk: {chunk.model_dump_json(indent=2)}")
+            if debug_chunks:
+                logger.debug("[LLM Client DEBUG] Raw Chunk: %s", chunk.model_dump_json(indent=2))
             # --- End Debug Logging --- 
             
-            yield chunk
+            choices = chunk.choices
+            if choices: # The trailing usage-only chunk has no choices
+                stream_delta = _to_stream_delta(choices[0])
+                if stream_delta.content:
+                    content_parts.append(stream_delta.content)
+                if stream_delta.tool_calls:
+                    content_parts.extend(arguments for _, _, _, arguments in stream_delta.tool_calls if arguments)
+                yield stream_delta
             
         # --- Post-Stream Cost Calculation using token_counter --- 
         try:
-            # Calculate tokens using litellm.token_counter after stream completion
-            prompt_tokens_calculated = litellm.token_counter(model=model_name, messages=messages)
-            completion_tokens_calculated = litellm.token_counter(model=model_name, text=response_content) if response_content else 0
-            print(f"[LLM Client] Tokens calculated via token_counter: P={prompt_tokens_calculated}, C={completion_tokens_calculated}")
+            # Prefer the usage the provider reported (stream_options.include_usage); otherwise count with
+            # litellm.token_counter, tokenizing the whole-history prompt in a worker thread
+            if captured_prompt_tokens is not None:
+                prompt_tokens_calculated = captured_prompt_tokens
+            else:
+                prompt_tokens_calculated = await asyncio.to_thread(litellm.token_counter, model=model_name, messages=messages)
+            if captured_completion_tokens is not None:
+                completion_tokens_calculated = captured_completion_tokens
+            else:
+                completion_tokens_calculated = litellm.token_counter(model=model_name, text="".join(content_parts)) if content_parts else 0
+            logger.info("[LLM Client] Tokens calculated: P=%s, C=%s", prompt_tokens_calculated, completion_tokens_calculated)
             
             # Calculate cost using these token counts
             input_cost, output_cost = litellm.cost_per_token(
@@ -113,26 +273,25 @@ async def get_llm_response_stream(
                 completion_tokens=completion_tokens_calculated
             )
             manual_cost = input_cost + output_cost
-            print(f"[LLM Client] Calculated cost via token_counter: ${manual_cost:.6f}")
+            logger.info("[LLM Client] Calculated cost: $%.6f", manual_cost)
             calculated_cost = manual_cost # Assign the calculated cost
             
         except Exception as cost_calc_e:
-            print(f"[LLM Client Warning] Failed to calculate cost via token_counter: {cost_calc_e}")
+            logger.warning("[LLM Client] Failed to calculate cost via token_counter: %s", cost_calc_e)
             calculated_cost = 0.0 # Default to 0 if calculation fails
         # --- End Post-Stream Cost Calculation ---
 
     except litellm.AuthenticationError as auth_error: # ADDED: Specific handler for Auth errors
-        print(f"[LLM Client Error - LiteLLM] Authentication Error for {llm_provider_name}: {auth_error}") # ADDED
+        logger.error("[LLM Client Error - LiteLLM] Authentication Error for %s: %s", llm_provider_name, auth_error) # ADDED
         yield {"type": "error", "content": f"Authentication failed for {llm_provider_name}. Please set a valid API key in Settings."} # ADDED User-friendly message
         error_yielded = True # Mark that we yielded an error
     except Exception as e:
         # Catch potential LiteLLM specific errors or general errors
-        print(f"[LLM Client Error - LiteLLM] Error during LLM stream request: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("[LLM Client Error - LiteLLM] Error during LLM stream request: %s", e)
         yield {"type": "error", "content": f"LLM Call Error: {e}"} # RESTORED yield for general errors
         error_yielded = True # Mark that we yielded an error
     finally:
+        _LLM_SEMAPHORE.release()
         # Yield the final cost (or None) in a tuple after everything
         # Using a specific type identifier in the tuple
         # Ensure calculated_cost exists even if stream fails before calculation
@@ -0,0 +1,45 @@
+"""
+Regression tests for ChatAgent memory eviction.
+"""
+
+from core.agent.agent import ChatAgent
+
+
+def _agent_with_budget(max_memory_tokens: int) -> ChatAgent:
+    agent = ChatAgent(model_name="gpt-4.1-mini")
+    agent.max_memory_tokens = max_memory_tokens
+    return agent
+
+
+def test_oversized_tool_result_keeps_the_user_turn():
+    agent = _agent_with_budget(500)
+    agent.add_message_to_memory(role="user", content="Read the log file please")
+    tool_calls = [{"id": "call_1", "type": "function", "function": {"name": "read_file", "arguments": "{\"path\": \"app.log\"}"}}]
+    agent.add_message_to_memory(role="assistant", tool_calls=tool_calls)
+    agent.add_message_to_memory(role="tool", tool_call_id="call_1", content="log line\n" * 2000)
+
+    assert [message["role"] for message in agent.memory] == ["system", "user", "assistant", "tool"]
+
+
+def test_turns_before_the_protected_tail_are_evicted():
+    agent = _agent_with_budget(500)
+    agent.recent_turns_kept = 1
+    agent.add_message_to_memory(role="user", content="First question " * 100)
+    agent.add_message_to_memory(role="assistant", content="First answer " * 100)
+    agent.add_message_to_memory(role="user", content="Second question")
+
+    assert [message["role"] for message in agent.memory] == ["system", "user"]
+    assert agent.memory[1]["content"] == "Second question"
+
+
+
+def test_old_tool_outputs_count_at_their_truncated_size():
+    agent = _agent_with_budget(4000)
+    agent.max_recent_messages = 4
+    history = [("user", "Read the big file", None), ("assistant", "Reading it", None), ("tool", "x " * 20000, "call_0")]
+    for turn in range(1, 4):
+        history += [("user", f"Read file {turn}", None), ("assistant", "Reading it", None), ("tool", "small file", f"call_{turn}")]
+    agent.load_memory(history)
+
+    # Untruncated the first output alone exceeds the budget, but it is old enough to be sent head + tail only
+    assert len(agent.memory) == 13
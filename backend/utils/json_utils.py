@@ -0,0 +1,56 @@
+"""JSON helpers that use orjson when it is installed and fall back to the standard library."""
+
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, stdlib json is used instead
+    orjson = None
+
+# Fallback encoders built once: json.dumps constructs a new encoder on every call with non-default options
+_COMPACT_ENCODE = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+_COMPACT_SORTED_ENCODE = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False, sort_keys=True).encode
+
+
+def dumps_bytes(obj: Any, sort_keys: bool = False) -> bytes:
+    """Serializes obj to compact UTF-8 JSON bytes (same output with or without orjson)."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else None)
+    return (_COMPACT_SORTED_ENCODE if sort_keys else _COMPACT_ENCODE)(obj).encode()
+
+
+def dumps(obj: Any, sort_keys: bool = False, pretty: bool = False) -> str:
+    """Serializes obj to a JSON string, compact unless pretty (two-space indent) is set."""
+    if orjson is not None:
+        option = 0
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option or None).decode()
+    if pretty:
+        return json.dumps(obj, indent=2, ensure_ascii=False, sort_keys=sort_keys)
+    return (_COMPACT_SORTED_ENCODE if sort_keys else _COMPACT_ENCODE)(obj)
+
+
+def loads(data: str | bytes) -> Any:
+    """Parses JSON text; decode errors are json.JSONDecodeError either way (orjson's subclasses it)."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class LazyJSON:
+    """Wraps an object so it is only serialized when formatted, e.g. by an enabled log handler."""
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj: Any):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        try:
+            return dumps(self.obj)
+        except TypeError:
+            return json.dumps(self.obj, default=str, ensure_ascii=False)
@@ -0,0 +1,101 @@
+"""Non-blocking logging: records are queued by the caller and written to stderr in batches."""
+
+import logging
+import queue
+import sys
+import threading
+import traceback
+from logging.handlers import QueueHandler
+from typing import Optional
+
+_LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+_LOG_QUEUE_SIZE = 10000 # Bounded so a stalled stderr can't grow memory without limit
+
+
+class _BatchedStderrWriter(threading.Thread):
+    """Drains the log queue every interval and writes everything pending with a single write()."""
+
+    def __init__(self, log_queue: "queue.Queue[logging.LogRecord]", flush_interval: float):
+        super().__init__(name="log-writer", daemon=True)
+        self.log_queue = log_queue
+        self.flush_interval = flush_interval
+        self.formatter = logging.Formatter(_LOG_FORMAT)
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.flush_interval):
+            self._flush()
+        self._flush() # Write whatever was logged during shutdown
+
+    def _flush(self) -> None:
+        lines = []
+        while True:
+            try:
+                record = self.log_queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                lines.append(self.formatter.format(record))
+            except Exception:
+                self._report_error(record) # One bad record must not end the thread
+        if lines:
+            try:
+                sys.stderr.write("\n".join(lines) + "\n")
+                sys.stderr.flush()
+            except Exception:
+                self._report_error(None)
+
+    def _report_error(self, record: Optional[logging.LogRecord]) -> None:
+        """Reports a formatting or write failure the way logging.Handler.handleError does."""
+        if not logging.raiseExceptions:
+            return
+        try:
+            sys.stderr.write("--- Logging error ---\n")
+            traceback.print_exc(file=sys.stderr)
+            if record is not None:
+                sys.stderr.write(f"Message: {record.msg!r}\nArguments: {record.args!r}\n")
+        except Exception:
+            pass # stderr itself is gone; nothing left to report to
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """Queue handler that drops records instead of blocking when the queue is full."""
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+_writer: Optional[_BatchedStderrWriter] = None
+_handler: Optional[_DroppingQueueHandler] = None
+
+
+def start_logging(level: int = logging.INFO, flush_interval: float = 0.1) -> None:
+    """Routes root logging through the queue and starts the background writer (call on startup)."""
+    global _writer, _handler
+    if _writer is not None:
+        return
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=_LOG_QUEUE_SIZE)
+    _handler = _DroppingQueueHandler(log_queue)
+    root = logging.getLogger()
+    root.addHandler(_handler)
+    root.setLevel(level)
+    _writer = _BatchedStderrWriter(log_queue, flush_interval)
+    _writer.start()
+
+
+def stop_logging() -> None:
+    """Flushes pending records and stops the background writer (call on shutdown)."""
+    global _writer, _handler
+    if _writer is None:
+        return
+    logging.getLogger().removeHandler(_handler)
+    _writer.stop()
+    _writer = None
+    _handler = None
@@ -1,4 +1,5 @@
 import WebSocket from 'ws';
+import type { BrowserWindow } from 'electron';
 import { getMainWindow } from './window-manager';
 import { getCurrentChatId, clearPendingToolCalls, addPendingToolCall, registerWebSocketFunctions } from './chat-session';
 import { executeTool } from '../tools/tool-executor';
@@ -84,151 +85,13 @@ export function connectWebSocket(): void {
     
     try {
       const messageData = JSON.parse(data.toString());
-      const messageType = messageData.type;
-
-      switch (messageType) {
-        case 'chunk':
-          if (!isStreaming) {
-            // Start of a new stream
-            isStreaming = true;
-            console.log('[WebSocket] Sending stream-start');
-            mainWindow.webContents.send('stream-start', { isUser: false });
-          }
-          // Send the chunk content
-          mainWindow.webContents.send('stream-chunk', { delta: messageData.content });
-          break;
-
-        case 'end':
-          if (isStreaming) {
-            // End of the current stream
-            isStreaming = false;
-            console.log('[WebSocket] Sending stream-end');
-            mainWindow.webContents.send('stream-end');
-          }
-          break;
-
-        case 'error':
-        case 'warning': // Treat warnings like errors for UI display
-          // Handle errors/warnings sent explicitly from backend
-          isStreaming = false; // Stop streaming if an error occurs
-          console.error(`[WebSocket] Received backend ${messageType}:`, messageData.content);
-          // Use toast notification for errors and warnings
-          mainWindow.webContents.send('toast-notification', { 
-            text: messageData.content
-          });
-          break;
-            
-        case 'tool_call_request': // Specifically for run_bash_command now
-          isStreaming = false; // Stop any active text streaming
-          console.log('[WebSocket] Received tool_call_request:', messageData.tool_calls);
-          
-          const receivedToolCalls: ToolCall[] = messageData.tool_calls;
-          if (receivedToolCalls && Array.isArray(receivedToolCalls)) {
-            receivedToolCalls.forEach((call: ToolCall) => {
-              if (call.id && call.type === 'function' && call.function?.name) { // Basic validation
-                // Auto-execute paste_at_cursor
-                if (call.function.name === 'paste_at_cursor') {
-                  console.log(`[WebSocket] Auto-executing paste_at_cursor: ${call.id}`);
-                  // Directly execute without asking user
-                  executeTool(ws, mainWindow, call, 'approved');
-                  // Ensure we send an end signal after auto-execution
-                  mainWindow?.webContents.send('stream-end');
-                } else {
-                  // Store other client-side tools for approval
-                  addPendingToolCall(call);
-                  console.log(`[WebSocket] Stored pending tool call for approval: ${call.id} (${call.function.name})`);
-                  // Forward the request to the renderer process for approval
-                  console.log('[WebSocket] Sending tool-call-request-from-main for approval');
-                  mainWindow?.webContents.send('tool-call-request-from-main', [call]); // Send only the one needing approval
-                }
-              } else {
-                console.error('[WebSocket] Invalid tool call format in received list:', call);
-              }
-            });
-          } else {
-            console.error('[WebSocket] Invalid tool_call_request format received.');
-            mainWindow.webContents.send('message-from-main', { 
-              text: '[Internal Error: Invalid tool request format]', 
-              isUser: false 
-            });
-          }
-          break;    
-
-        // Handle ask_user and terminate
-        case 'ask_user_request':
-          isStreaming = false;
-          const question = messageData.question;
-          console.log('[WebSocket] Sending ask-user-request-from-main');
-          mainWindow.webContents.send('ask-user-request-from-main', question);
-          break;
-        
-        case 'terminate_request':
-          isStreaming = false;
-          const reason = messageData.reason;
-          console.log('[WebSocket] Sending terminate-request-from-main');
-          mainWindow.webContents.send('terminate-request-from-main', reason);
-          break;
-
-        // Handle Agent Updates
-        case 'agent_question':
-          isStreaming = false; // Stop any text stream
-          const questionData = { 
-            question: messageData.question, 
-            request_id: messageData.request_id 
-          };
-          console.log(`[WebSocket] Sending agent-question-from-main: ${questionData.request_id}`);
-          mainWindow.webContents.send('agent-question-from-main', questionData);
-          break;
-
-        case 'agent_step_update':
-          // Don't change isStreaming for step updates, they happen during agent processing
-          const updateData = messageData.data; // Should contain thoughts, action, url
-          console.log('[WebSocket] Sending agent-step-update-from-main');
-          mainWindow.webContents.send('agent-step-update-from-main', updateData);
-          break;
-
-        // Handle Cost Update
-        case 'cost_update':
-          const costPayload: CostUpdatePayload = { 
-            total_cost: messageData.total_cost 
-          };
-          console.log(`[WebSocket] Sending cost-update-from-main: $${costPayload.total_cost.toFixed(6)}`);
-          mainWindow.webContents.send('cost-update-from-main', costPayload);
-          break;
-
-        // Handle Transcription Result from Backend
-        case 'transcription_result':
-          const transcribedText = messageData.text;
-          console.log(`[WebSocket] Sending transcription-result-from-main: ${transcribedText.substring(0, 50)}...`);
-          mainWindow.webContents.send('transcription-result-from-main', transcribedText);
-          break;
-
-        case 'info':
-          console.log(`[WebSocket] Info from backend: ${messageData.content}`);
-          // Reset streaming state and send end signal for stop requests
-          isStreaming = false;
-          mainWindow.webContents.send('stream-end');
-          mainWindow.webContents.send('toast-notification', { 
-            text: messageData.content
-          });
-          break;
-
-        default:
-          // Handle potential older format or unexpected messages gracefully
-          // If we received something unexpected, assume any active stream ends
-          if (isStreaming) {
-            console.warn('[WebSocket] Stream ended due to unexpected message format.');
-            isStreaming = false;
-            mainWindow.webContents.send('stream-end'); 
-          }
-          console.warn('[WebSocket] Received unexpected message format:', messageData);
-          // Check if it has a 'response' field for backward compatibility or other cases
-          if (messageData.response) {
-            mainWindow.webContents.send('message-from-main', { 
-              text: messageData.response, 
-              isUser: false 
-            });
-          } 
+      if (messageData.type === 'batch') {
+        // Several messages the backend sent together, in order
+        for (const frame of messageData.frames) {
+          handleBackendMessage(frame, mainWindow);
+        }
+      } else {
+        handleBackendMessage(messageData, mainWindow);
       }
     } catch (error) {
       isStreaming = false; // Stop streaming on parsing error
@@ -283,6 +146,163 @@ export function connectWebSocket(): void {
   });
 }
 
+/**
+ * Handles one message from the backend (a frame, or one entry of a batch frame)
+ */
+function handleBackendMessage(messageData: any, mainWindow: BrowserWindow): void {
+  const messageType = messageData.type;
+
+  switch (messageType) {
+    case 'chunk':
+      if (!isStreaming) {
+        // Start of a new stream
+        isStreaming = true;
+        console.log('[WebSocket] Sending stream-start');
+        mainWindow.webContents.send('stream-start', { isUser: false });
+      }
+      // Send the chunk content
+      mainWindow.webContents.send('stream-chunk', { delta: messageData.content });
+      break;
+
+    case 'end':
+      if (isStreaming) {
+        // End of the current stream
+        isStreaming = false;
+        console.log('[WebSocket] Sending stream-end');
+        mainWindow.webContents.send('stream-end');
+      }
+      break;
+
+    case 'error':
+    case 'warning': // Treat warnings like errors for UI display
+      // Handle errors/warnings sent explicitly from backend
+      isStreaming = false; // Stop streaming if an error occurs
+      console.error(`[WebSocket] Received backend ${messageType}:`, messageData.content);
+      // Use toast notification for errors and warnings
+      mainWindow.webContents.send('toast-notification', { 
+        text: messageData.content
+      });
+      break;
+          
+    case 'tool_call_request': // Specifically for run_bash_command now
+      isStreaming = false; // Stop any active text streaming
+      console.log('[WebSocket] Received tool_call_request:', messageData.tool_calls);
+        
+      const receivedToolCalls: ToolCall[] = messageData.tool_calls;
+      if (receivedToolCalls && Array.isArray(receivedToolCalls)) {
+        receivedToolCalls.forEach((call: ToolCall) => {
+          if (call.id && call.type === 'function' && call.function?.name) { // Basic validation
+            // Auto-execute paste_at_cursor
+            if (call.function.name === 'paste_at_cursor') {
+              console.log(`[WebSocket] Auto-executing paste_at_cursor: ${call.id}`);
+              // Directly execute without asking user
+              executeTool(ws, mainWindow, call, 'approved');
+              // Ensure we send an end signal after auto-execution
+              mainWindow?.webContents.send('stream-end');
+            } else {
+              // Store other client-side tools for approval
+              addPendingToolCall(call);
+              console.log(`[WebSocket] Stored pending tool call for approval: ${call.id} (${call.function.name})`);
+              // Forward the request to the renderer process for approval
+              console.log('[WebSocket] Sending tool-call-request-from-main for approval');
+              mainWindow?.webContents.send('tool-call-request-from-main', [call]); // Send only the one needing approval
+            }
+          } else {
+            console.error('[WebSocket] Invalid tool call format in received list:', call);
+          }
+        });
+      } else {
+        console.error('[WebSocket] Invalid tool_call_request format received.');
+        mainWindow.webContents.send('message-from-main', { 
+          text: '[Internal Error: Invalid tool request format]', 
+          isUser: false 
+        });
+      }
+      break;    
+
+    case 'tool_call_partial':
+      // Early notice of an upcoming tool call; the tool_call_request that follows is what gets executed
+      console.log(`[WebSocket] Agent is about to run: ${messageData.call?.function?.name}`, messageData.call?.function?.arguments);
+      break;
+
+    // Handle ask_user and terminate
+    case 'ask_user_request':
+      isStreaming = false;
+      const question = messageData.question;
+      console.log('[WebSocket] Sending ask-user-request-from-main');
+      mainWindow.webContents.send('ask-user-request-from-main', question);
+      break;
+      
+    case 'terminate_request':
+      isStreaming = false;
+      const reason = messageData.reason;
+      console.log('[WebSocket] Sending terminate-request-from-main');
+      mainWindow.webContents.send('terminate-request-from-main', reason);
+      break;
+
+    // Handle Agent Updates
+    case 'agent_question':
+      isStreaming = false; // Stop any text stream
+      const questionData = { 
+        question: messageData.question, 
+        request_id: messageData.request_id 
+      };
+      console.log(`[WebSocket] Sending agent-question-from-main: ${questionData.request_id}`);
+      mainWindow.webContents.send('agent-question-from-main', questionData);
+      break;
+
+    case 'agent_step_update':
+      // Don't change isStreaming for step updates, they happen during agent processing
+      const updateData = messageData.data; // Should contain thoughts, action, url
+      console.log('[WebSocket] Sending agent-step-update-from-main');
+      mainWindow.webContents.send('agent-step-update-from-main', updateData);
+      break;
+
+    // Handle Cost Update
+    case 'cost_update':
+      const costPayload: CostUpdatePayload = { 
+        total_cost: messageData.total_cost 
+      };
+      console.log(`[WebSocket] Sending cost-update-from-main: $${costPayload.total_cost.toFixed(6)}`);
+      mainWindow.webContents.send('cost-update-from-main', costPayload);
+      break;
+
+    // Handle Transcription Result from Backend
+    case 'transcription_result':
+      const transcribedText = messageData.text;
+      console.log(`[WebSocket] Sending transcription-result-from-main: ${transcribedText.substring(0, 50)}...`);
+      mainWindow.webContents.send('transcription-result-from-main', transcribedText);
+      break;
+
+    case 'info':
+      console.log(`[WebSocket] Info from backend: ${messageData.content}`);
+      // Reset streaming state and send end signal for stop requests
+      isStreaming = false;
+      mainWindow.webContents.send('stream-end');
+      mainWindow.webContents.send('toast-notification', { 
+        text: messageData.content
+      });
+      break;
+
+    default:
+      // Handle potential older format or unexpected messages gracefully
+      // If we received something unexpected, assume any active stream ends
+      if (isStreaming) {
+        console.warn('[WebSocket] Stream ended due to unexpected message format.');
+        isStreaming = false;
+        mainWindow.webContents.send('stream-end'); 
+      }
+      console.warn('[WebSocket] Received unexpected message format:', messageData);
+      // Check if it has a 'response' field for backward compatibility or other cases
+      if (messageData.response) {
+        mainWindow.webContents.send('message-from-main', { 
+          text: messageData.response, 
+          isUser: false 
+        });
+      } 
+  }
+}
+
 /**
  * Sends a message to the WebSocket server
  * @param message - The message to send
@@ -4,17 +4,17 @@ import { BrowserWindow, clipboard } from 'electron';
 import fs from 'node:fs/promises'; // Import fs for file operations
 import path from 'node:path'; // Import path for joining
 import os from 'os'; // Import os for homedir
-import type { ToolCall } from '../types'; // Assuming types.ts is in the same directory or adjust path
+import type { ToolCall, ToolResultPayload, ToolCallStartedPayload } from '../types'; // Assuming types.ts is in the same directory or adjust path
 
 /**
  * Sends the result of a tool execution back to the backend via WebSocket.
  */
-export function sendToolResultToBackend(ws: WebSocket | null, mainWindow: BrowserWindow | null, toolCallId: string, content: string) {
+export function sendToolResultToBackend(ws: WebSocket | null, mainWindow: BrowserWindow | null, toolCallId: string, content: string, denied: boolean = false) {
     if (ws && ws.readyState === WebSocket.OPEN) {
-        const resultPayload = {
+        const resultPayload: ToolResultPayload = {
             type: 'tool_result',
             results: [
-                { tool_call_id: toolCallId, content: content }
+                { tool_call_id: toolCallId, content: content, denied: denied }
             ]
         };
         console.log('[WebSocket Send] Sending tool_result:', resultPayload);
@@ -28,12 +28,24 @@ export function sendToolResultToBackend(ws: WebSocket | null, mainWindow: Browse
     }
 }
 
+/**
+ * Tells the backend an approved tool call has started. The backend only times out calls that are
+ * running, so time the user spends on the approval prompt doesn't count against the call.
+ */
+function sendToolCallStartedToBackend(ws: WebSocket | null, toolCallId: string) {
+    if (ws && ws.readyState === WebSocket.OPEN) {
+        const startedPayload: ToolCallStartedPayload = { type: 'tool_call_started', tool_call_ids: [toolCallId] };
+        ws.send(JSON.stringify(startedPayload));
+    }
+}
+
 /**
  * Executes a tool based on the provided ToolCall object and decision.
  * Currently handles 'run_bash_command'.
  */
 export function executeTool(ws: WebSocket | null, mainWindow: BrowserWindow | null, pendingCall: ToolCall, decision: 'approved' | 'denied') {
     if (decision === 'approved') {
+        sendToolCallStartedToBackend(ws, pendingCall.id);
         // --- Handle Specific Tool Types ---
         if (pendingCall.function.name === 'run_bash_command') {
             executeBashCommand(ws, mainWindow, pendingCall);
@@ -65,7 +77,7 @@ export function executeTool(ws: WebSocket | null, mainWindow: BrowserWindow | nu
         // User denied execution
         const denialMessage = "User denied execution.";
         console.log(`[Tool Executor] User denied execution for ${pendingCall.id}`);
-        sendToolResultToBackend(ws, mainWindow, pendingCall.id, denialMessage);
+        sendToolResultToBackend(ws, mainWindow, pendingCall.id, denialMessage, true);
         // --- Send denial info to frontend ---
         if (mainWindow) {
             mainWindow.webContents.send('command-output-from-main', denialMessage);
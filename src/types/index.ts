@@ -49,7 +49,13 @@ export interface ChatMessageProps {
 // Define the structure for sending a tool result back to main
 export interface ToolResultPayload {
     type: 'tool_result';
-    results: Array<{ tool_call_id: string; content: string; }>;
+    results: Array<{ tool_call_id: string; content: string; denied?: boolean; }>;
+}
+
+// Tells the backend an approved tool call is now running, so its reply timeout starts
+export interface ToolCallStartedPayload {
+    type: 'tool_call_started';
+    tool_call_ids: string[];
 }
 
 // Define the structure for cost update messages